@@ -23,10 +23,14 @@ Módulo customizado para implementar hierarquia de unidades de vendas
         'security/crm_lead_stage_history_security.xml',
         'security/crm_sales_unit_attendance_rules.xml',  # atualizado para hr.attendance
         'data/ir_cron.xml',
+        'data/crm_stage_data.xml',
         'views/quick_create_opportunity_wizard_views.xml',
         'views/quick_create_opportunity_wizard_action.xml',
         'views/crm_lead_kanban_custom.xml',
         'views/crm_sales_unit_views.xml',
+        'views/crm_stage_views.xml',
+        'views/crm_sales_unit_transfer_views.xml',
+        'views/crm_sales_unit_hierarchy_views.xml',
         'views/res_users_views.xml',
         'views/crm_sales_unit_config_views.xml',
         'views/crm_sales_unit_attendance_views.xml',  # aponta para hr.attendance
@@ -1 +1,2 @@
-from . import funnel_controller
\ No newline at end of file
+from . import funnel_controller
+from . import sales_unit_controller
@@ -1,5 +1,45 @@
-from odoo import http
-from odoo.http import request
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytz
+from werkzeug.exceptions import BadRequest
+
+from odoo import http, api
+from odoo.http import request, content_disposition
+from odoo.modules.registry import Registry
+
+from odoo.addons.crm_sales_unit.models.crm_lead_stage_funnel_daily import FUNNEL_TZ
+
+# Teto do tamanho de lote da exportação (linhas por consulta)
+MAX_EXPORT_BATCH_SIZE = 20000
+
+
+def _parse_iso_datetime(value):
+    """Aceita 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM:SS' e ISO 8601 com 'T', frações,
+    'Z' ou offset; levanta ValueError para qualquer outro formato."""
+    text = str(value).strip()
+    if text[-1:] in ('Z', 'z'):
+        text = text[:-1] + '+00:00'
+    return datetime.fromisoformat(text)
+
+
+def _to_funnel_day(value):
+    """Dia do funil: datas com fuso são convertidas para o fuso do funil"""
+    parsed = _parse_iso_datetime(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(pytz.timezone(FUNNEL_TZ))
+    return parsed.date()
+
+
+def _to_utc_datetime(value):
+    """Datetime ingênuo em UTC, como gravado em date_stage_change"""
+    parsed = _parse_iso_datetime(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(pytz.UTC).replace(tzinfo=None)
+    return parsed
+
 
 class FunnelController(http.Controller):
 
@@ -11,43 +51,97 @@ class FunnelController(http.Controller):
 
     @http.route('/crm_funnel_dashboard/data', type='json', auth='user')
     def data(self, date_from=None, date_to=None, user_id=None):
-        """Retorna contagem distinta de leads por estágio, com filtros"""
+        """Retorna contagem de leads por estágio, com filtros.
+
+        Lê o funil diário consolidado (crm.lead.stage.funnel.daily): um lead
+        conta uma vez por estágio, no dia e para o corretor da sua primeira
+        passagem por ele. Diferente da contagem sobre o histórico bruto, um lead
+        que volta ao estágio (ou é redistribuído) em outro período não conta de
+        novo, e o período é filtrado por dia inteiro no fuso do funil.
+        """
+        try:
+            day_from = _to_funnel_day(date_from) if date_from else None
+            day_to = _to_funnel_day(date_to) if date_to else None
+            user_id = int(user_id) if user_id else None
+        except (TypeError, ValueError):
+            raise BadRequest('Parâmetros inválidos: use datas ISO 8601 e user_id inteiro.')
+
+        Daily = request.env['crm.lead.stage.funnel.daily'].sudo()
+
+        # Estágios do painel, na ordem do funil configurada em crm.stage
+        stages = request.env['crm.stage']._get_funnel_dashboard_stages()
+
+        # Uma única agregação (soma) sobre a tabela consolidada
+        counts_by_stage = Daily._count_leads_by_stage(
+            [stage_id for stage_id, _name in stages],
+            day_from=day_from,
+            day_to=day_to,
+            user_id=user_id,
+        )
+
+        counts = {
+            name: counts_by_stage.get(stage_id, 0)
+            for stage_id, name in stages
+        }
+        return {'counts': counts}
+
+    @http.route('/crm_funnel_dashboard/history/export', type='http', auth='user', methods=['GET'])
+    def export_history(self, fmt='csv', date_from=None, date_to=None, user_id=None, batch_size=5000, **kw):
+        """Exporta o histórico de etapas em streaming (CSV ou NDJSON).
+
+        Usa um cursor próprio e paginação por (date_stage_change, id): a memória
+        não cresce com o volume e as regras de visibilidade do usuário se aplicam.
+        """
+        if fmt not in ('csv', 'ndjson'):
+            return request.make_response('Formato inválido: use csv ou ndjson.', status=400)
+
+        try:
+            batch_size = max(1, min(int(batch_size), MAX_EXPORT_BATCH_SIZE))
+            user_id = int(user_id) if user_id else None
+            date_from = _to_utc_datetime(date_from) if date_from else None
+            date_to = _to_utc_datetime(date_to) if date_to else None
+        except (TypeError, ValueError):
+            return request.make_response(
+                'Parâmetros inválidos: batch_size e user_id devem ser inteiros e as datas, ISO 8601.',
+                status=400,
+            )
+
         domain = []
         if date_from:
             domain.append(('date_stage_change', '>=', date_from))
         if date_to:
             domain.append(('date_stage_change', '<=', date_to))
         if user_id:
-            domain.append(('user_id', '=', int(user_id)))
-
-        stages = [
-            "Novo",
-            "Primeiro Contato",
-            "Qualificando",
-            "Agendado",
-            "Análise",
-            "Aprovado",
-            "Venda Fechada",
-        ]
+            domain.append(('user_id', '=', user_id))
 
-        counts = {}
-        Stage = request.env['crm.stage'].sudo()
-        Hist = request.env['crm.lead.stage.history'].sudo()
-
-        for name in stages:
-            stage = Stage.search([('name', '=', name)], limit=1)
-            if not stage:
-                counts[name] = 0
-                continue
-
-            # Usar read_group para contar DISTINCT lead_id
-            data = Hist.read_group(
-                domain + [('stage_id', '=', stage.id)],
-                ['lead_id'],
-                ['lead_id']
-            )
-            # Cada grupo representa um lead distinto
-            cnt = len(data)
-            counts[name] = cnt
+        # Falha cedo (antes do streaming) se o usuário não puder ler o histórico
+        request.env['crm.lead.stage.history'].check_access('read')
 
-        return {'counts': counts}
+        dbname = request.env.cr.dbname
+        uid = request.env.uid
+        context = dict(request.env.context)
+
+        def generate():
+            with Registry(dbname).cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                History = env['crm.lead.stage.history']
+                # Cabeçalho fixo, vindo dos campos exportados: sai mesmo sem nenhuma linha
+                header = History._get_export_columns()
+                if fmt == 'csv':
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerow(header)
+                    yield buffer.getvalue().encode()
+                for rows in History._iter_export_batches(domain, batch_size):
+                    if fmt == 'ndjson':
+                        yield ''.join(json.dumps(row, default=str) + '\n' for row in rows).encode()
+                        continue
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows([row.get(col, '') for col in header] for row in rows)
+                    yield buffer.getvalue().encode()
+
+        filename = 'historico_etapas.%s' % fmt
+        headers = [
+            ('Content-Type', 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson'),
+            ('Content-Disposition', content_disposition(filename)),
+        ]
+        return request.make_response(generate(), headers=headers)
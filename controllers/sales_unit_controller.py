@@ -0,0 +1,15 @@
+from odoo import http
+from odoo.http import request
+
+class SalesUnitController(http.Controller):
+
+    @http.route('/crm_sales_unit/org_tree', type='json', auth='user')
+    def org_tree(self):
+        """Retorna a árvore de unidades visível ao usuário, com agregados por unidade.
+
+        A versão da hierarquia permite ao cliente saber se a estrutura mudou.
+        """
+        return {
+            'version': request.env['crm.sales.unit.hierarchy.log']._get_hierarchy_version(),
+            'units': request.env['crm.sales.unit'].get_org_tree(),
+        }
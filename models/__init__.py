@@ -2,11 +2,18 @@
 from . import res_users
 from . import res_partner
 from . import crm_sales_unit
+from . import crm_sales_unit_transfer
+from . import crm_sales_unit_hierarchy_log
+from . import crm_sales_unit_visibility_job
 from . import crm_leads
+from . import crm_stage
 from . import calendar_event
 from . import quick_create_opportunity_wizard
 from . import crm_sales_unit_config
 from . import hr_employee
 from . import crm_lead_stage_history
+from . import crm_lead_stage_history_archive
+from . import crm_lead_stage_funnel_daily
+from . import crm_lead_stage_reached
 from . import lead_redistribution_log
 from . import redistribute_lead
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, time, timedelta
+import logging
+
+import pytz
+
+from odoo import models, fields, api
+from odoo.tools.sql import table_exists
+
+_logger = logging.getLogger(__name__)
+
+# Fuso usado para definir o "dia" do funil (mesmo do expediente)
+FUNNEL_TZ = "America/Sao_Paulo"
+# Dias a reconsolidar: cada gravação de histórico marca os seus dias na mesma
+# transação, então linhas que commitam atrasadas nunca ficam de fora
+DIRTY_DAYS_TABLE = "crm_lead_stage_funnel_daily_dirty"
+LOCAL_DAY_SQL = "(h.date_stage_change AT TIME ZONE 'UTC' AT TIME ZONE %(tz)s)::date"
+
+# Primeira passagem de cada (lead, etapa), no histórico quente ou arquivado.
+# Em empate de data, o arquivo vem antes e, na mesma tabela, o menor id.
+FIRST_PASSAGE_SQL = """
+    NOT EXISTS (
+        SELECT 1 FROM crm_lead_stage_history p
+         WHERE p.lead_id = c.lead_id AND p.stage_id = c.stage_id
+           AND (p.date_stage_change < c.date_stage_change
+                OR (NOT c.archived AND p.date_stage_change = c.date_stage_change AND p.id < c.id))
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM crm_lead_stage_history_archive p
+         WHERE p.lead_id = c.lead_id AND p.stage_id = c.stage_id
+           AND (p.date_stage_change < c.date_stage_change
+                OR (p.date_stage_change = c.date_stage_change AND (NOT c.archived OR p.id < c.id)))
+    )
+"""
+
+
+class LeadStageFunnelDaily(models.Model):
+    """Leads que atingiram cada etapa pela primeira vez, consolidados por dia.
+
+    Cada (lead, etapa) conta uma única vez: no dia, responsável, unidade e UTM
+    da sua primeira passagem pela etapa. Por isso lead_count é somável em
+    qualquer recorte (dias, responsáveis, origens), e o total de um período é o
+    número de leads distintos que chegaram à etapa pela primeira vez nele.
+    Voltas à etapa e redistribuições não contam de novo.
+    """
+    _name = "crm.lead.stage.funnel.daily"
+    _description = "Funil de Vendas Diário (consolidado)"
+    _order = "day desc, stage_id"
+    _rec_name = "day"
+
+    day = fields.Date(string="Dia", required=True, index=True, readonly=True)
+    stage_id = fields.Many2one("crm.stage", string="Etapa", index=True, readonly=True)
+    user_id = fields.Many2one("res.users", string="Responsável", index=True, readonly=True)
+    sales_unit_id = fields.Many2one("crm.sales.unit", string="Unidade de Vendas", index=True, readonly=True)
+    source_id = fields.Many2one("utm.source", string="Origem do Lead", readonly=True)
+    campaign_id = fields.Many2one("utm.campaign", string="Campanha", readonly=True)
+    medium_id = fields.Many2one("utm.medium", string="Mídia", readonly=True)
+    lead_count = fields.Integer(string="Leads", readonly=True)
+
+    def init(self):
+        cr = self.env.cr
+        if not table_exists(cr, DIRTY_DAYS_TABLE):
+            # Sem índice único: transações concorrentes marcam o mesmo dia sem se bloquear
+            cr.execute(f"CREATE TABLE {DIRTY_DAYS_TABLE} (day DATE NOT NULL)")
+            # Primeira instalação/atualização: todos os dias do histórico serão consolidados
+            cr.execute(f"""
+                INSERT INTO {DIRTY_DAYS_TABLE} (day)
+                SELECT DISTINCT {LOCAL_DAY_SQL}
+                  FROM (
+                        SELECT date_stage_change FROM crm_lead_stage_history
+                     UNION ALL
+                        SELECT date_stage_change FROM crm_lead_stage_history_archive
+                       ) h
+            """, {"tz": FUNNEL_TZ})
+
+    @api.model
+    def _mark_dirty_history(self, history):
+        """Marca os dias das linhas novas e, se alguma delas passou a ser a primeira
+        passagem do lead pela etapa (commit atrasado), o dia da primeira anterior"""
+        if not history:
+            return
+        history.flush_recordset()
+        self.env.cr.execute(f"""
+            INSERT INTO {DIRTY_DAYS_TABLE} (day)
+            SELECT {LOCAL_DAY_SQL}
+              FROM crm_lead_stage_history h
+             WHERE h.id = ANY(%(ids)s)
+             UNION
+            SELECT {LOCAL_DAY_SQL}
+              FROM crm_lead_stage_history n
+              JOIN crm_lead_stage_history h
+                ON h.lead_id = n.lead_id AND h.stage_id = n.stage_id
+               AND h.date_stage_change > n.date_stage_change
+             WHERE n.id = ANY(%(ids)s)
+        """, {"tz": FUNNEL_TZ, "ids": history.ids})
+
+    @api.model
+    def _mark_dirty_history_ids(self, start_id, end_id):
+        """Marca os dias das linhas de histórico com id em [start_id, end_id)"""
+        self.env.cr.execute(f"""
+            INSERT INTO {DIRTY_DAYS_TABLE} (day)
+            SELECT DISTINCT {LOCAL_DAY_SQL}
+              FROM crm_lead_stage_history h
+             WHERE h.id >= %(start)s AND h.id < %(end)s
+        """, {"tz": FUNNEL_TZ, "start": start_id, "end": end_id})
+
+    @api.model
+    def _day_ranges_utc(self, days):
+        """Dias locais agrupados em intervalos contíguos [início, fim) em UTC naive"""
+        tz = pytz.timezone(FUNNEL_TZ)
+
+        def to_utc(day):
+            return tz.localize(datetime.combine(day, time.min)).astimezone(pytz.UTC).replace(tzinfo=None)
+
+        ranges = []
+        for day in sorted(days):
+            if ranges and ranges[-1][1] == day:
+                ranges[-1][1] = day + timedelta(days=1)
+            else:
+                ranges.append([day, day + timedelta(days=1)])
+        return [to_utc(start) for start, _end in ranges], [to_utc(end) for _start, end in ranges]
+
+    # ======================================================
+    # CONSOLIDAÇÃO INCREMENTAL (CRON)
+    # ======================================================
+    @api.model
+    def _cron_update_rollup(self):
+        """Reconsolida, inteiros, os dias marcados desde a última execução"""
+        self.env["crm.lead.stage.history"]._flush_history_buffer()
+        self.env.flush_all()
+        cr = self.env.cr
+
+        cr.execute(f"DELETE FROM {DIRTY_DAYS_TABLE} RETURNING day")
+        days = sorted({row[0] for row in cr.fetchall()})
+        if not days:
+            return 0
+
+        # Filtra por intervalos de date_stage_change (usa o índice), não pelo dia calculado.
+        # O arquivo entra na consolidação para que dias antigos não se percam.
+        starts, ends = self._day_ranges_utc(days)
+        cr.execute("DELETE FROM crm_lead_stage_funnel_daily WHERE day = ANY(%s)", [days])
+        cr.execute(f"""
+            WITH ranges AS (
+                SELECT * FROM unnest(%(starts)s::timestamp[], %(ends)s::timestamp[]) AS r(range_start, range_end)
+            ),
+            c AS (
+                SELECT h.id, FALSE AS archived, h.lead_id, h.stage_id, h.user_id, h.sales_unit_id,
+                       h.source_id, h.campaign_id, h.medium_id, h.date_stage_change
+                  FROM ranges r
+                  JOIN crm_lead_stage_history h
+                    ON h.date_stage_change >= r.range_start AND h.date_stage_change < r.range_end
+             UNION ALL
+                SELECT h.id, TRUE, h.lead_id, h.stage_id, h.user_id, h.sales_unit_id,
+                       h.source_id, h.campaign_id, h.medium_id, h.date_stage_change
+                  FROM ranges r
+                  JOIN crm_lead_stage_history_archive h
+                    ON h.date_stage_change >= r.range_start AND h.date_stage_change < r.range_end
+            )
+            INSERT INTO crm_lead_stage_funnel_daily (
+                day, stage_id, user_id, sales_unit_id, source_id, campaign_id, medium_id,
+                lead_count, create_uid, create_date, write_uid, write_date
+            )
+            SELECT (c.date_stage_change AT TIME ZONE 'UTC' AT TIME ZONE %(tz)s)::date,
+                   c.stage_id, c.user_id, c.sales_unit_id, c.source_id, c.campaign_id, c.medium_id,
+                   COUNT(*),
+                   %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM c
+             WHERE {FIRST_PASSAGE_SQL}
+          GROUP BY 1, 2, 3, 4, 5, 6, 7
+        """, {"tz": FUNNEL_TZ, "uid": self.env.uid, "starts": starts, "ends": ends})
+        inserted = cr.rowcount
+
+        self.invalidate_model()
+        _logger.info("Funil diário reconsolidado para %s dias (%s linhas)", len(days), inserted)
+        return len(days)
+
+    # ======================================================
+    # LEITURA (PAINEL DO FUNIL)
+    # ======================================================
+    @api.model
+    def _count_leads_by_stage(self, stage_ids, day_from=None, day_to=None, user_id=None):
+        """{stage_id: leads que atingiram a etapa pela primeira vez no período}"""
+        domain = [("stage_id", "in", list(stage_ids))]
+        if day_from:
+            domain.append(("day", ">=", day_from))
+        if day_to:
+            domain.append(("day", "<=", day_to))
+        if user_id:
+            domain.append(("user_id", "=", user_id))
+        return {
+            stage.id: count
+            for stage, count in self._read_group(domain, ["stage_id"], ["lead_count:sum"])
+        }
@@ -1,4 +1,21 @@
-from odoo import models, fields
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# Chave do buffer de histórico em cr.precommit.data (por transação)
+HISTORY_BUFFER_KEY = "crm_sales_unit.stage_history_buffer"
+# Tabela temporária de marcas: uma linha por lote acumulado, desfeita junto com o
+# savepoint em que o lote foi acumulado
+HISTORY_BUFFER_MARKS = "crm_sales_unit_history_buffer_mark"
+
+# Colunas da exportação em streaming (ordem do CSV)
+EXPORT_FIELDS = [
+    "date_stage_change", "lead_id", "stage_id", "user_id", "sales_unit_id",
+    "source_id", "campaign_id", "medium_id", "lead_creation_date",
+]
+
 
 class LeadStageHistory(models.Model):
     _name = "crm.lead.stage.history"
@@ -27,8 +44,6 @@ class LeadStageHistory(models.Model):
     sales_unit_id = fields.Many2one(
         "crm.sales.unit",
         string="Unidade de Vendas",
-        related="user_id.sales_unit_id",
-        store=True,
         index=True
     )
     date_stage_change = fields.Datetime(
@@ -43,33 +58,201 @@ class LeadStageHistory(models.Model):
     source_id = fields.Many2one(
         "utm.source",
         string="Origem do Lead",
-        related="lead_id.source_id",
-        store=True,
         index=True
     )
     campaign_id = fields.Many2one(
         "utm.campaign",
         string="Campanha",
-        related="lead_id.campaign_id",
-        store=True,
         index=True
     )
     medium_id = fields.Many2one(
         "utm.medium",
         string="Mídia",
-        related="lead_id.medium_id",
-        store=True,
         index=True
     )
 
 
-    # Sobrescrevemos create para congelar os dados no momento da gravação
-    def create(self, vals):
-        if vals.get("user_id"):
-            user = self.env["res.users"].browse(vals["user_id"])
-            vals["sales_unit_id"] = user.sales_unit_id.id if user.sales_unit_id else False
+    # Sobrescrevemos create para congelar os dados no momento da gravação.
+    # Unidade e UTM não são related armazenados: mudar a origem de um lead ou a
+    # unidade de um corretor não reescreve o histórico (ver _backfill_snapshots).
+    @api.model_create_multi
+    def create(self, vals_list):
+        # Pré-carrega usuários e leads do lote inteiro (uma leitura por modelo)
+        users = self.env["res.users"].sudo().browse(
+            {vals["user_id"] for vals in vals_list if vals.get("user_id")}
+        )
+        leads = self.env["crm.lead"].sudo().browse(
+            {vals["lead_id"] for vals in vals_list if vals.get("lead_id")}
+        )
+        unit_by_user = {user.id: user.sales_unit_id.id for user in users}
+        lead_snapshots = {
+            lead.id: {
+                "lead_creation_date": lead.create_date,
+                "source_id": lead.source_id.id,
+                "campaign_id": lead.campaign_id.id,
+                "medium_id": lead.medium_id.id,
+            }
+            for lead in leads
+        }
+
+        for vals in vals_list:
+            if vals.get("user_id"):
+                vals["sales_unit_id"] = unit_by_user.get(vals["user_id"]) or False
+
+            if vals.get("lead_id") in lead_snapshots:
+                vals.update(lead_snapshots[vals["lead_id"]])
+        history = super(LeadStageHistory, self).create(vals_list)
+        self.env["crm.lead.stage.reached"].sudo()._register_history(history)
+        self.env["crm.lead.stage.funnel.daily"]._mark_dirty_history(history)
+        return history
+
+    # ======================================================
+    # EXPORTAÇÃO EM STREAMING
+    # ======================================================
+    @api.model
+    def _get_export_columns(self):
+        """Colunas da exportação, na ordem das linhas de _iter_export_batches"""
+        columns = ["id"]
+        for fname in EXPORT_FIELDS:
+            columns.append(fname)
+            if self._fields[fname].type == "many2one":
+                columns.append(fname.removesuffix("_id") + "_name")
+        return columns
+
+    @api.model
+    def _iter_export_batches(self, domain, batch_size=5000):
+        """Percorre o histórico visível em lotes, paginando por (date_stage_change, id).
+
+        Cada lote é uma lista de dicts prontos para serialização (valores vazios
+        como None: célula vazia no CSV, null no NDJSON); o cache do ambiente é
+        descartado entre lotes para manter a memória constante.
+        """
+        last = None
+        while True:
+            keyset = []
+            if last:
+                keyset = [
+                    "|", ("date_stage_change", ">", last[0]),
+                    "&", ("date_stage_change", "=", last[0]), ("id", ">", last[1]),
+                ]
+            batch = self.search(
+                domain + keyset, order="date_stage_change, id", limit=batch_size
+            )
+            if not batch:
+                return
+            rows = []
+            for rec in batch.read(EXPORT_FIELDS):
+                row = {"id": rec["id"]}
+                for fname in EXPORT_FIELDS:
+                    value = rec[fname]
+                    if isinstance(value, tuple):
+                        row[fname] = value[0]
+                        row[fname.removesuffix("_id") + "_name"] = value[1]
+                    elif fname.endswith("_id"):
+                        row[fname] = None
+                        row[fname.removesuffix("_id") + "_name"] = ""
+                    else:
+                        row[fname] = fields.Datetime.to_string(value) if value else None
+                rows.append(row)
+            last = (batch[-1].date_stage_change, batch[-1].id)
+            self.env.invalidate_all()
+            yield rows
+
+    @api.model
+    def _backfill_snapshots(self, chunk_size=50000, include_sales_unit=False, auto_commit=False):
+        """Ressincroniza as fotografias de UTM (e, opcionalmente, da unidade) com
+        os valores atuais do lead/corretor, em blocos de ids.
+
+        Uso explícito, ex. pelo shell:
+            env['crm.lead.stage.history']._backfill_snapshots(auto_commit=True)
+        """
+        self._flush_history_buffer()
+        self.env.flush_all()
+        self.env.cr.execute("SELECT MIN(id), MAX(id) FROM crm_lead_stage_history")
+        min_id, max_id = self.env.cr.fetchone()
+        if min_id is None:
+            return 0
+
+        unit_sql = ", sales_unit_id = u.sales_unit_id" if include_sales_unit else ""
+        updated = 0
+        for start in range(min_id, max_id + 1, chunk_size):
+            self.env.cr.execute(f"""
+                UPDATE crm_lead_stage_history h
+                   SET source_id = l.source_id,
+                       campaign_id = l.campaign_id,
+                       medium_id = l.medium_id{unit_sql}
+                  FROM crm_lead l, res_users u
+                 WHERE l.id = h.lead_id
+                   AND u.id = h.user_id
+                   AND h.id >= %s AND h.id < %s
+            """, (start, start + chunk_size))
+            updated += self.env.cr.rowcount
+            _logger.info("Backfill do histórico de etapas: ids %s a %s (%s linhas)",
+                         start, start + chunk_size - 1, self.env.cr.rowcount)
+            # Os dias reescritos são reconsolidados pelo funil diário
+            self.env["crm.lead.stage.funnel.daily"]._mark_dirty_history_ids(start, start + chunk_size)
+            if auto_commit:
+                self.env.cr.commit()
+
+        self.invalidate_model(["source_id", "campaign_id", "medium_id", "sales_unit_id"])
+        self.env.ref("crm_sales_unit.cron_funnel_daily_rollup")._trigger()
+        return updated
+
+    def init(self):
+        # Suporte à paginação por chave (date_stage_change, id) da exportação
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS crm_lead_stage_history_date_id_idx
+                ON crm_lead_stage_history (date_stage_change, id)
+        """)
+        # Primeira passagem de cada (lead, etapa), usada pelo funil diário
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS crm_lead_stage_history_lead_stage_date_idx
+                ON crm_lead_stage_history (lead_id, stage_id, date_stage_change)
+        """)
+
+    def _search(self, domain, *args, **kwargs):
+        # Leitura do histórico de leads específicos na mesma transação enxerga o buffer;
+        # relatórios e regras de acesso não antecipam a gravação
+        if HISTORY_BUFFER_KEY in self.env.cr.precommit.data and any(
+            isinstance(leaf, (list, tuple)) and leaf[0] == "lead_id" for leaf in domain
+        ):
+            self._flush_history_buffer()
+        return super(LeadStageHistory, self)._search(domain, *args, **kwargs)
+
+    # ======================================================
+    # BUFFER DE HISTÓRICO POR TRANSAÇÃO
+    # ======================================================
+    @api.model
+    def _buffer_history(self, vals_list):
+        """Acumula linhas de histórico para um único INSERT multi-linha no precommit"""
+        if not vals_list:
+            return
+        cr = self.env.cr
+        precommit = cr.precommit
+        batches = precommit.data.get(HISTORY_BUFFER_KEY)
+        if batches is None:
+            batches = precommit.data[HISTORY_BUFFER_KEY] = []
+            precommit.add(self._flush_history_buffer)
+        # O buffer em memória sobrevive a rollbacks de savepoint (linhas com erro no
+        # load(), simulações); a marca no banco não, e só lotes marcados são gravados
+        cr.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS {HISTORY_BUFFER_MARKS} (mark INTEGER NOT NULL) ON COMMIT DELETE ROWS;
+            INSERT INTO {HISTORY_BUFFER_MARKS} (mark) VALUES (%s);
+        """, [len(batches)])
+        batches.append(vals_list)
 
-        if vals.get("lead_id"):
-            lead = self.env["crm.lead"].browse(vals["lead_id"])
-            vals["lead_creation_date"] = lead.create_date
-        return super(LeadStageHistory, self).create(vals)
+    @api.model
+    def _flush_history_buffer(self):
+        """Grava em lote o histórico acumulado na transação"""
+        batches = self.env.cr.precommit.data.pop(HISTORY_BUFFER_KEY, None)
+        if not batches:
+            return self.browse()
+        # Lotes acumulados em savepoints desfeitos perderam a marca
+        self.env.cr.execute(f"DELETE FROM {HISTORY_BUFFER_MARKS} RETURNING mark")
+        kept = {row[0] for row in self.env.cr.fetchall()}
+        vals_list = [vals for mark, batch in enumerate(batches) if mark in kept for vals in batch]
+        if not vals_list:
+            return self.browse()
+        history = self.sudo().create(vals_list)
+        self.env.flush_all()
+        return history
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# Meses mantidos na tabela quente crm_lead_stage_history
+HOT_MONTHS_PARAM = "crm_sales_unit.history_hot_months"
+DEFAULT_HOT_MONTHS = 12
+
+ARCHIVE_COLUMNS = """
+    lead_id, stage_id, user_id, sales_unit_id, date_stage_change, lead_creation_date,
+    source_id, campaign_id, medium_id, create_uid, create_date, write_uid, write_date
+"""
+
+
+class LeadStageHistoryArchive(models.Model):
+    _name = "crm.lead.stage.history.archive"
+    _description = "Histórico de Etapas do Lead (Arquivo)"
+    _order = "date_stage_change desc, id desc"
+    _rec_name = "lead_id"
+
+    lead_id = fields.Many2one("crm.lead", string="Lead", required=True, ondelete="restrict", index=True, readonly=True)
+    stage_id = fields.Many2one("crm.stage", string="Etapa", required=True, index=True, readonly=True)
+    user_id = fields.Many2one("res.users", string="Responsável", required=True, index=True, readonly=True)
+    sales_unit_id = fields.Many2one("crm.sales.unit", string="Unidade de Vendas", index=True, readonly=True)
+    date_stage_change = fields.Datetime(string="Data da Mudança", required=True, index=True, readonly=True)
+    lead_creation_date = fields.Datetime(string="Data de Criação do Lead", readonly=True)
+    source_id = fields.Many2one("utm.source", string="Origem do Lead", readonly=True)
+    campaign_id = fields.Many2one("utm.campaign", string="Campanha", readonly=True)
+    medium_id = fields.Many2one("utm.medium", string="Mídia", readonly=True)
+
+    def init(self):
+        # Mesmo índice da tabela quente para a primeira passagem do funil diário
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS crm_lead_stage_history_archive_lead_stage_date_idx
+                ON crm_lead_stage_history_archive (lead_id, stage_id, date_stage_change)
+        """)
+
+    # ======================================================
+    # ARQUIVAMENTO DO HISTÓRICO FRIO (CRON)
+    # ======================================================
+    @api.model
+    def _get_archive_cutoff(self):
+        """Início do mês mais antigo que permanece na tabela quente"""
+        months = int(self.env["ir.config_parameter"].sudo().get_param(HOT_MONTHS_PARAM, DEFAULT_HOT_MONTHS))
+        today = fields.Date.context_today(self)
+        return fields.Datetime.to_datetime(today.replace(day=1) - relativedelta(months=months))
+
+    @api.model
+    def _cron_archive_old_history(self, batch_size=50000, auto_commit=False):
+        """Move, em lotes, o histórico anterior ao corte para a tabela de arquivo"""
+        self.env["crm.lead.stage.history"]._flush_history_buffer()
+        self.env.flush_all()
+        cutoff = self._get_archive_cutoff()
+
+        moved = 0
+        while True:
+            self.env.cr.execute(f"""
+                WITH moved AS (
+                    DELETE FROM crm_lead_stage_history
+                     WHERE id IN (
+                        SELECT id FROM crm_lead_stage_history
+                         WHERE date_stage_change < %s
+                      ORDER BY date_stage_change, id
+                         LIMIT %s
+                     )
+                 RETURNING {ARCHIVE_COLUMNS}
+                )
+                INSERT INTO crm_lead_stage_history_archive ({ARCHIVE_COLUMNS})
+                SELECT {ARCHIVE_COLUMNS} FROM moved
+            """, (cutoff, batch_size))
+            count = self.env.cr.rowcount
+            moved += count
+            if auto_commit:
+                self.env.cr.commit()
+            if count < batch_size:
+                break
+
+        self.env["crm.lead.stage.history"].invalidate_model()
+        self.invalidate_model()
+        _logger.info("Histórico de etapas arquivado antes de %s: %s linhas", cutoff, moved)
+        return moved
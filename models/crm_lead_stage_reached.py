@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, api
+
+# Consolida linhas de histórico em (lead, etapa, responsável); {where} filtra o histórico
+REACHED_SELECT = """
+    SELECT h.lead_id, h.stage_id, h.user_id,
+           (ARRAY_AGG(h.sales_unit_id ORDER BY h.date_stage_change, h.id))[1],
+           (ARRAY_AGG(h.source_id ORDER BY h.date_stage_change, h.id))[1],
+           (ARRAY_AGG(h.campaign_id ORDER BY h.date_stage_change, h.id))[1],
+           (ARRAY_AGG(h.medium_id ORDER BY h.date_stage_change, h.id))[1],
+           MIN(h.lead_creation_date),
+           MIN(h.date_stage_change),
+           MAX(h.date_stage_change),
+           COUNT(*),
+           %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+      FROM crm_lead_stage_history h
+     {where}
+  GROUP BY h.lead_id, h.stage_id, h.user_id
+"""
+
+REACHED_COLUMNS = """
+    lead_id, stage_id, user_id, sales_unit_id, source_id, campaign_id, medium_id,
+    lead_creation_date, first_reached, last_reached, reach_count,
+    create_uid, create_date, write_uid, write_date
+"""
+
+
+class LeadStageReached(models.Model):
+    _name = "crm.lead.stage.reached"
+    _description = "Lead que Atingiu a Etapa (fato para BI)"
+    _order = "last_reached desc"
+    _rec_name = "lead_id"
+
+    lead_id = fields.Many2one("crm.lead", string="Lead", required=True, ondelete="cascade", readonly=True)
+    stage_id = fields.Many2one("crm.stage", string="Etapa", required=True, index=True, readonly=True)
+    user_id = fields.Many2one("res.users", string="Responsável", required=True, index=True, readonly=True)
+    sales_unit_id = fields.Many2one("crm.sales.unit", string="Unidade de Vendas", index=True, readonly=True)
+    source_id = fields.Many2one("utm.source", string="Origem do Lead", readonly=True)
+    campaign_id = fields.Many2one("utm.campaign", string="Campanha", readonly=True)
+    medium_id = fields.Many2one("utm.medium", string="Mídia", readonly=True)
+    lead_creation_date = fields.Datetime(string="Data de Criação do Lead", readonly=True)
+    first_reached = fields.Datetime(string="Primeira Vez na Etapa", required=True, index=True, readonly=True)
+    last_reached = fields.Datetime(string="Última Vez na Etapa", required=True, readonly=True)
+    reach_count = fields.Integer(string="Passagens", readonly=True)
+
+    _sql_constraints = [
+        ('lead_stage_user_unique', 'unique(lead_id, stage_id, user_id)',
+         'Já existe um registro para este lead, etapa e responsável.'),
+    ]
+
+    def init(self):
+        # Carga inicial a partir do histórico existente
+        self.env.cr.execute("SELECT 1 FROM crm_lead_stage_reached LIMIT 1")
+        if self.env.cr.fetchone():
+            return
+        self.env.cr.execute(
+            f"INSERT INTO crm_lead_stage_reached ({REACHED_COLUMNS}) "
+            + REACHED_SELECT.format(where=""),
+            {"uid": self.env.uid},
+        )
+
+    @api.model
+    def _register_history(self, history):
+        """Atualiza o fato com linhas recém-gravadas de crm.lead.stage.history"""
+        if not history:
+            return
+        history.flush_recordset()
+        self.env.cr.execute(
+            f"INSERT INTO crm_lead_stage_reached ({REACHED_COLUMNS}) "
+            + REACHED_SELECT.format(where="WHERE h.id IN %(ids)s")
+            + """
+            ON CONFLICT (lead_id, stage_id, user_id) DO UPDATE SET
+                first_reached = LEAST(crm_lead_stage_reached.first_reached, EXCLUDED.first_reached),
+                last_reached = GREATEST(crm_lead_stage_reached.last_reached, EXCLUDED.last_reached),
+                reach_count = crm_lead_stage_reached.reach_count + EXCLUDED.reach_count,
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date
+            """,
+            {"uid": self.env.uid, "ids": tuple(history.ids)},
+        )
+        self.invalidate_model()
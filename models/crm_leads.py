@@ -1,22 +1,5 @@
 from odoo import models, fields, api
 
-STAGES_ORDER = [
-    "Novo",
-    "Primeiro Contato",
-    "Qualificando",
-    "Agendado",
-    "Reagendar",
-    "Preparando Pasta",
-    "Pasta completa",
-    "Análise",
-    "Aprovado",
-    "Reprovado",
-    "Fluxo Agendado",
-    "Aguardando Retorno",
-    "Venda Fechada",
-    "Repasse",
-]
-
 class CrmLead(models.Model):
     _inherit = "crm.lead"
 
@@ -26,27 +9,51 @@ class CrmLead(models.Model):
         store=True,
         index=True
     )
+    # Marcado na criação, com a distribuição habilitada: só esses leads vão para a fila
+    queue_dispatch = fields.Boolean(string="Aguardando Distribuição", default=False, copy=False, readonly=True)
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS crm_lead_queue_dispatch_idx
+                ON crm_lead (create_date, id)
+             WHERE queue_dispatch AND user_id IS NULL
+        """)
 
     @api.model_create_multi
     def create(self, vals_list):
         leads = super(CrmLead, self).create(vals_list)
+        history_vals = []
         for lead in leads:
-            if lead.stage_id:
-                self.env["crm.lead.stage.history"].create({
+            # Leads sem corretor (aguardando a fila) só entram no histórico na primeira atribuição
+            if lead.stage_id and lead.user_id:
+                history_vals.append({
                     "lead_id": lead.id,
                     "stage_id": lead.stage_id.id,
                     "user_id": lead.user_id.id,
                     "date_stage_change": fields.Datetime.now(),
                     "lead_creation_date": lead.create_date,
                 })
+        self.env["crm.lead.stage.history"]._buffer_history(history_vals)
+
+        # Leads sem corretor entram na distribuição da fila logo após o commit
+        unassigned = leads.filtered(lambda lead: not lead.user_id)
+        if unassigned and self.env["crm.sales.unit.config"]._is_dispatch_enabled():
+            unassigned.sudo().write({"queue_dispatch": True})
+            cron = self.env.ref("crm_sales_unit.cron_dispatch_leads", raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
         return leads
 
     def write(self, vals):
-        old_stages = {lead.id: lead.stage_id.name for lead in self}
+        old_stages = {lead.id: lead.stage_id.id for lead in self}
         old_users = {lead.id: lead.user_id for lead in self}
 
         res = super(CrmLead, self).write(vals)
 
+        # Histórico é acumulado e gravado em lote no precommit da transação
+        history_vals = []
+        Stage = self.env["crm.stage"]
+
         # --- Lógica de mudança de corretor ---
         if "user_id" in vals:
             for lead in self:
@@ -54,9 +61,9 @@ class CrmLead(models.Model):
                 new_user = lead.user_id
                 if old_user and old_user != new_user:
                     # registrar histórico de "Reprovado" para o antigo corretor
-                    lost_stage = self.env["crm.stage"].search([("name", "=", "Reprovado")], limit=1)
+                    lost_stage = Stage._get_stage_by_name("Reprovado")
                     if lost_stage:
-                        self.env["crm.lead.stage.history"].create({
+                        history_vals.append({
                             "lead_id": lead.id,
                             "stage_id": lost_stage.id,
                             "user_id": old_user.id,
@@ -64,59 +71,42 @@ class CrmLead(models.Model):
                             "lead_creation_date": lead.create_date,
                         })
                     # registrar histórico de "Novo" para o novo corretor
-                    new_stage = self.env["crm.stage"].search([("name", "=", "Novo")], limit=1)
+                    new_stage = Stage._get_stage_by_name("Novo")
                     if new_stage:
-                        self.env["crm.lead.stage.history"].create({
+                        history_vals.append({
                             "lead_id": lead.id,
                             "stage_id": new_stage.id,
                             "user_id": new_user.id,
                             "date_stage_change": fields.Datetime.now(),
                             "lead_creation_date": lead.create_date,
                         })
+                elif not old_user and new_user and lead.stage_id and "stage_id" not in vals:
+                    # primeira atribuição: registra a etapa atual para o corretor
+                    history_vals.append({
+                        "lead_id": lead.id,
+                        "stage_id": lead.stage_id.id,
+                        "user_id": new_user.id,
+                        "date_stage_change": fields.Datetime.now(),
+                        "lead_creation_date": lead.create_date,
+                    })
 
         # --- Lógica de mudança de estágio ---
         if "stage_id" in vals:
-            for lead in self:
-                origin = old_stages[lead.id]
-                dest = lead.stage_id.name
-
-                def _create_history(stage_rec, user):
-                    self.env["crm.lead.stage.history"].create({
+            # (origem, destino) → intermediárias, conforme a posição dos estágios no funil
+            transitions = Stage._get_funnel_transitions()
+            for lead in self.filtered("user_id"):
+                intermediarias = transitions.get((old_stages[lead.id], lead.stage_id.id), ())
+                for stage_id in intermediarias + (lead.stage_id.id,):
+                    history_vals.append({
                         "lead_id": lead.id,
-                        "stage_id": stage_rec.id,
-                        "user_id": user.id,
+                        "stage_id": stage_id,
+                        "user_id": lead.user_id.id,
                         "date_stage_change": fields.Datetime.now(),
                         "lead_creation_date": lead.create_date,
                     })
 
-                # Proteção contra estágios fora da lista
-                if origin not in STAGES_ORDER or dest not in STAGES_ORDER:
-                    _create_history(lead.stage_id, lead.user_id)
-                    continue
-
-                origin_index = STAGES_ORDER.index(origin)
-                dest_index = STAGES_ORDER.index(dest)
+        self.env["crm.lead.stage.history"]._buffer_history(history_vals)
 
-                if dest_index > origin_index:
-                    intermediarias = STAGES_ORDER[origin_index+1:dest_index]
-                    for stage in intermediarias:
-                        if stage not in ["Reprovado", "Reagendar"]:
-                            stage_rec = self.env["crm.stage"].search([("name", "=", stage)], limit=1)
-                            if stage_rec:
-                                _create_history(stage_rec, lead.user_id)
-                    _create_history(lead.stage_id, lead.user_id)
-
-                elif dest in ["Reprovado", "Reagendar"]:
-                    intermediarias = STAGES_ORDER[origin_index+1:dest_index]
-                    for stage in intermediarias:
-                        if stage not in ["Reprovado", "Reagendar"]:
-                            stage_rec = self.env["crm.stage"].search([("name", "=", stage)], limit=1)
-                            if stage_rec:
-                                _create_history(stage_rec, lead.user_id)
-                    _create_history(lead.stage_id, lead.user_id)
-
-                else:
-                    _create_history(lead.stage_id, lead.user_id)
         #garante a visibilidade do contato tbm
         if "user_id" in vals:
             for lead in self:
@@ -124,3 +114,8 @@ class CrmLead(models.Model):
                     lead.partner_id.user_id = lead.user_id
 
         return res
+
+    def unlink(self):
+        # Grava o histórico pendente antes: o ondelete="restrict" precisa enxergá-lo
+        self.env["crm.lead.stage.history"]._flush_history_buffer()
+        return super(CrmLead, self).unlink()
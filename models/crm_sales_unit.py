@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api
-from odoo.exceptions import UserError, ValidationError
+import logging
+
+from odoo import models, fields, api, tools, _
+from odoo import SUPERUSER_ID
+from odoo.exceptions import UserError, ValidationError, AccessError
+
+_logger = logging.getLogger(__name__)
 
 class CRMSalesUnit(models.Model):
     _name = "crm.sales.unit"
@@ -38,7 +43,53 @@ class CRMSalesUnit(models.Model):
     # Status
     active = fields.Boolean(default=True)
 
+    # Campos que mudam o domínio de visibilidade (em cache nas ir.rule)
+    HIERARCHY_FIELDS = {"parent_id", "responsible_id", "active"}
+
+    _sql_constraints = [
+        (
+            "parent_required_check",
+            "CHECK(type = 'presidencia' OR parent_id IS NOT NULL)",
+            "Unidades que não são Presidência devem estar vinculadas a uma unidade superior.",
+        ),
+    ]
+
+    def init(self):
+        # Um responsável só pode atuar em uma unidade ativa por vez, mesmo sob edições concorrentes
+        cr = self.env.cr
+        # Bases antigas podem ter responsáveis duplicados (a checagem em Python tinha corrida):
+        # sem escolher por conta própria qual unidade perde o responsável, registra e adia o índice
+        cr.execute("""
+            SELECT responsible_id, array_agg(id ORDER BY id)
+              FROM crm_sales_unit
+             WHERE active AND responsible_id IS NOT NULL
+          GROUP BY responsible_id
+            HAVING COUNT(*) > 1
+        """)
+        duplicates = cr.fetchall()
+        if duplicates:
+            _logger.warning(
+                "Índice único de responsável não criado: responsáveis em mais de uma unidade ativa "
+                "(responsável: unidades) %s. Corrija as unidades e atualize o módulo novamente.",
+                "; ".join(f"{user_id}: {unit_ids}" for user_id, unit_ids in duplicates),
+            )
+            return
+        cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS crm_sales_unit_active_responsible_uniq
+                ON crm_sales_unit (responsible_id)
+             WHERE active AND responsible_id IS NOT NULL
+        """)
+
     # Regras de negócio
+    @api.model_create_multi
+    def create(self, vals_list):
+        units = super().create(vals_list)
+        self.env["crm.sales.unit.hierarchy.log"]._log_change("unit_create", units=units)
+        if any(vals.get("responsible_id") for vals in vals_list):
+            # A unidade chefiada compõe o domínio das regras em cache
+            self.env.registry.clear_cache()
+        return units
+
     def write(self, vals):
         if "active" in vals and vals["active"] is False:
             for unit in self:
@@ -48,10 +99,25 @@ class CRMSalesUnit(models.Model):
                         "Remaneje os corretores antes de arquivar." % unit.name
                     )
 
+        changed_fields = self.HIERARCHY_FIELDS & set(vals)
+        # Cadeia e responsáveis anteriores, que podem perder a visibilidade
+        previous_parents = self.parent_id if "parent_id" in vals else self.browse()
+        previous_responsibles = self.responsible_id if changed_fields else self.env["res.users"]
+
         res = super().write(vals)
 
-        self._check_unique_responsible()
-        self._check_parent_unit()
+        if changed_fields:
+            change_type = "unit_archive" if vals.get("active") is False else "unit_write"
+            self.env["crm.sales.unit.hierarchy.log"]._log_change(
+                change_type, units=self, changed_fields=changed_fields
+            )
+            # allowed_user_ids não depende da árvore no ORM: o recálculo incremental
+            # (ou o job, em lotes grandes) cobre as cadeias de ancestrais antiga e nova
+            previous_responsibles._refresh_allowed_user_ids(previous_parents | self)
+        if {"responsible_id", "active"} & set(vals):
+            # A unidade chefiada compõe o domínio das regras em cache; o resto
+            # (membros, pais, tipos) muda só a versão da hierarquia
+            self.env.registry.clear_cache()
 
         # Sincroniza responsável → sales_unit_id
         if "responsible_id" in vals:
@@ -63,28 +129,164 @@ class CRMSalesUnit(models.Model):
 
     @api.constrains("responsible_id", "active")
     def _check_unique_responsible(self):
-        for unit in self:
-            if unit.active and unit.responsible_id:
-                conflict = self.search([
-                    ("id", "!=", unit.id),
-                    ("responsible_id", "=", unit.responsible_id.id),
-                    ("active", "=", True),
-                ], limit=1)
-                if conflict:
-                    raise ValidationError(
-                        "O usuário %s já é responsável pela unidade '%s'. "
-                        "Um responsável só pode atuar em uma unidade ativa por vez."
-                        % (unit.responsible_id.name, conflict.name)
-                    )
+        """Mensagem amigável antes do índice único parcial; uma consulta por lote"""
+        responsibles = self.filtered("active").responsible_id
+        if not responsibles:
+            return
+        conflicts = self.with_context(active_test=True)._read_group(
+            [("responsible_id", "in", responsibles.ids)],
+            ["responsible_id"],
+            ["id:recordset"],
+            having=[("__count", ">", 1)],
+            limit=1,
+        )
+        for responsible, units in conflicts:
+            raise ValidationError(
+                "O usuário %s já é responsável pela unidade '%s'. "
+                "Um responsável só pode atuar em uma unidade ativa por vez."
+                % (responsible.name, (units - self or units)[0].name)
+            )
+
+    # ======================================================
+    # ÁRVORE DE UNIDADES (ORGANOGRAMA)
+    # ======================================================
+    @api.model
+    @tools.ormcache('version')
+    def _get_org_tree_structure(self, version):
+        """Estrutura de todas as unidades ativas, ordenada por parent_path.
+
+        Uma única consulta (unidades + responsáveis + contagem de membros),
+        em cache por versão da hierarquia.
+        """
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT u.id, u.name, u.type, u.parent_id, u.responsible_id, p.name,
+                   COALESCE(m.member_count, 0)
+              FROM crm_sales_unit u
+         LEFT JOIN res_users r ON r.id = u.responsible_id
+         LEFT JOIN res_partner p ON p.id = r.partner_id
+         LEFT JOIN (
+                SELECT sales_unit_id, COUNT(*) AS member_count
+                  FROM res_users
+                 WHERE active AND sales_unit_id IS NOT NULL
+              GROUP BY sales_unit_id
+              ) m ON m.sales_unit_id = u.id
+             WHERE u.active
+          ORDER BY u.parent_path
+        """)
+        return tuple(tuple(row) for row in self.env.cr.fetchall())
+
+    @api.model
+    def _get_org_tree_live_counts(self, unit_ids):
+        """{unit_id: (leads abertos, corretores com check-in aberto)} em uma consulta"""
+        if not unit_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT u.id, COALESCE(l.open_leads, 0), COALESCE(a.checked_in, 0)
+              FROM unnest(%(ids)s::int[]) AS u(id)
+         LEFT JOIN (
+                SELECT sales_unit_id, COUNT(*) AS open_leads
+                  FROM crm_lead
+                 WHERE active AND COALESCE(probability, 0) < 100
+                   AND sales_unit_id = ANY(%(ids)s)
+              GROUP BY sales_unit_id
+              ) l ON l.sales_unit_id = u.id
+         LEFT JOIN (
+                SELECT r.sales_unit_id, COUNT(DISTINCT e.user_id) AS checked_in
+                  FROM hr_attendance a
+                  JOIN hr_employee e ON e.id = a.employee_id
+                  JOIN res_users r ON r.id = e.user_id
+                 WHERE a.check_out IS NULL
+                   AND r.sales_unit_id = ANY(%(ids)s)
+              GROUP BY r.sales_unit_id
+              ) a ON a.sales_unit_id = u.id
+        """, {"ids": list(unit_ids)})
+        return {unit_id: (open_leads, checked_in) for unit_id, open_leads, checked_in in self.env.cr.fetchall()}
+
+    @api.model
+    def get_org_tree(self):
+        """Árvore visível ao usuário atual, com agregados por unidade"""
+        version = self.env["crm.sales.unit.hierarchy.log"]._get_hierarchy_cache_key()
+        auth = self.env["res.users"]._get_hierarchy_auth(self.env.uid)
+        structure = [row for row in self._get_org_tree_structure(version) if row[0] in auth.managed_unit_ids]
+        self.env["crm.lead"].flush_model(["sales_unit_id", "probability", "active"])
+        self.env["hr.attendance"].flush_model(["check_out"])
+        live_counts = self._get_org_tree_live_counts([row[0] for row in structure])
+
+        nodes = {}
+        roots = []
+        for unit_id, name, unit_type, parent_id, responsible_id, responsible_name, member_count in structure:
+            open_leads, checked_in = live_counts.get(unit_id, (0, 0))
+            node = nodes[unit_id] = {
+                "id": unit_id,
+                "name": name,
+                "type": unit_type,
+                "parent_id": parent_id,
+                "responsible": {"id": responsible_id, "name": responsible_name} if responsible_id else False,
+                "member_count": member_count,
+                "open_lead_count": open_leads,
+                "checked_in_count": checked_in,
+                "children": [],
+            }
+            # Ordem por parent_path garante que o pai já foi visto
+            if parent_id in nodes:
+                nodes[parent_id]["children"].append(node)
+            else:
+                roots.append(node)
+        return roots
+
+    # ======================================================
+    # REORGANIZAÇÃO EM LOTE
+    # ======================================================
+    def action_transfer_members(self, users):
+        """Transfere um conjunto de corretores para esta unidade em uma única escrita.
+
+        A validação de hierarquia e o recompute de visibilidade (uma vez, para
+        as unidades de origem e destino) ficam a cargo de res.users.write.
+        """
+        self.ensure_one()
+        users = users.filtered(lambda u: u.sales_unit_id != self)
+        source_units = users.mapped("sales_unit_id")
+        if users:
+            users.write({"sales_unit_id": self.id})
+
+        return self.env["crm.sales.unit.transfer.log"].sudo().create({
+            "operation": "members",
+            "source_unit_ids": [(6, 0, source_units.ids)],
+            "target_unit_id": self.id,
+            "user_ids": [(6, 0, users.ids)],
+            "user_count": len(users),
+            "executor_id": self.env.user.id,
+        })
+
+    def action_move_subtree(self, new_parent):
+        """Move esta unidade, com toda a subárvore, para outra unidade superior.
+
+        O ORM reescreve o parent_path da subárvore em um único UPDATE; a
+        visibilidade é recalculada só para os responsáveis das cadeias de
+        ancestrais antiga e nova (e presidentes).
+        """
+        self.ensure_one()
+        if self.env.user.id != SUPERUSER_ID:
+            auth = self.env["res.users"]._get_hierarchy_auth(self.env.uid)
+            if not {self.id, new_parent.id} <= auth.managed_unit_ids or self.id == auth.unit_id:
+                raise AccessError(_("Você só pode mover unidades abaixo da sua, para destinos na sua hierarquia."))
+        if new_parent.parent_path.startswith(self.parent_path):
+            raise UserError(_("Uma unidade não pode ser movida para dentro da própria subárvore."))
+
+        old_parent = self.parent_id
+        members = self.env["res.users"].sudo().search([("sales_unit_id", "child_of", self.id)])
+        self.write({"parent_id": new_parent.id})
 
-    @api.constrains("type", "parent_id")
-    def _check_parent_unit(self):
-        for unit in self:
-            if unit.type != "presidencia" and not unit.parent_id:
-                raise ValidationError(
-                    "A unidade '%s' do tipo '%s' deve estar vinculada a uma unidade superior."
-                    % (unit.name, unit.type)
-                )
+        return self.env["crm.sales.unit.transfer.log"].sudo().create({
+            "operation": "subtree",
+            "unit_id": self.id,
+            "source_unit_ids": [(6, 0, old_parent.ids)],
+            "target_unit_id": new_parent.id,
+            "user_ids": [(6, 0, members.ids)],
+            "user_count": len(members),
+            "executor_id": self.env.user.id,
+        })
 
     def unlink(self):
         raise UserError(
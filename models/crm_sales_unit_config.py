@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
+from odoo.tools.sql import table_exists
 from odoo.http import request
+from bisect import bisect_right
+from collections import defaultdict
 from datetime import datetime
 import ipaddress
 import math
@@ -9,6 +12,9 @@ import logging
 
 _logger = logging.getLogger(__name__)
 
+# Leads reservados por rodada de distribuição
+DISPATCH_BATCH_SIZE = 100
+
 # ---------------------------------------------------------
 # Configuração: locais, IPs permitidos, horário de expediente e Fila de leads (globais)
 # ---------------------------------------------------------
@@ -48,6 +54,65 @@ class CRMSalesUnitIP(models.Model):
             except ValueError:
                 raise ValidationError(_("O valor '%s' não é um IP ou range CIDR válido.") % record.cidr)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_ip_matcher(self):
+        """{versão do IP: (inícios, fins, ids)} com intervalos inteiros ordenados e disjuntos.
+
+        Dois CIDRs são sempre aninhados ou disjuntos, então basta manter o mais
+        externo de cada grupo aninhado. Montado uma vez por registry.
+        """
+        intervals = {4: [], 6: []}
+        for record in self.sudo().search_fetch([], ['cidr']):
+            network = ipaddress.ip_network(record.cidr, strict=False)
+            intervals[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), record.id)
+            )
+
+        matcher = {}
+        for version, items in intervals.items():
+            # Início crescente; em empate, o maior range primeiro
+            items.sort(key=lambda item: (item[0], -item[1]))
+            starts, ends, ids = [], [], []
+            for start, end, record_id in items:
+                if ends and start <= ends[-1]:
+                    continue  # contido no range anterior
+                starts.append(start)
+                ends.append(end)
+                ids.append(record_id)
+            matcher[version] = (tuple(starts), tuple(ends), tuple(ids))
+        return matcher
+
+    @api.model
+    def _has_ranges(self):
+        return any(starts for starts, _ends, _ids in self._get_ip_matcher().values())
+
+    @api.model
+    def _match_ip(self, ip_obj):
+        """Range que contém o IP (busca binária, sem consulta ao banco), ou vazio"""
+        starts, ends, ids = self._get_ip_matcher()[ip_obj.version]
+        value = int(ip_obj)
+        index = bisect_right(starts, value) - 1
+        if index >= 0 and value <= ends[index]:
+            return self.browse(ids[index])
+        return self.browse()
+
 
 class CRMSalesUnitQueue(models.Model):
     _name = "crm.sales.unit.queue"
@@ -58,12 +123,122 @@ class CRMSalesUnitQueue(models.Model):
     checkin_time = fields.Datetime(string="Hora de Entrada")
     active = fields.Boolean(string="Ativo na Fila", default=True)
     date = fields.Date(string="Data", default=fields.Date.today, required=True)
+    last_assigned_at = fields.Datetime(string="Último Lead Recebido", readonly=True)
+    assigned_count = fields.Integer(string="Leads Recebidos", default=0, readonly=True)
+
+    _sql_constraints = [
+        ('employee_date_unique', 'unique(employee_id, date)', 'O funcionário já está na fila nesta data!'),
+    ]
+
+    def _auto_init(self):
+        # Bases antigas podem ter entradas duplicadas por funcionário/data (add_to_queue não
+        # deduplicava): mantém a ativa mais recente, senão a constraint única não é criada
+        if table_exists(self.env.cr, self._table):
+            self.env.cr.execute("""
+                DELETE FROM crm_sales_unit_queue
+                 WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                                   PARTITION BY employee_id, date
+                                   ORDER BY active DESC, id DESC
+                               ) AS position
+                          FROM crm_sales_unit_queue
+                         WHERE employee_id IS NOT NULL
+                    ) ranked
+                     WHERE position > 1
+                 )
+            """)
+            if self.env.cr.rowcount:
+                _logger.info("Fila: %s entradas duplicadas removidas antes da constraint única", self.env.cr.rowcount)
+        return super()._auto_init()
 
     def remove_from_queue(self):
         for rec in self:
             rec.active = False
             _logger.info("Registro %s removido da fila", rec.id)
 
+    # ---------------------------------------------------------
+    # Distribuição de leads em rodízio
+    # ---------------------------------------------------------
+    @api.model
+    def _dispatch_leads(self, batch_size=DISPATCH_BATCH_SIZE):
+        """Distribui leads sem corretor entre os corretores da fila, em rodízio.
+
+        Só entram leads marcados para a fila na criação (queue_dispatch), nunca
+        leads antigos ou importados sem corretor.
+
+        Leads e entradas da fila são reservados com FOR UPDATE SKIP LOCKED:
+        workers concorrentes pegam conjuntos disjuntos, sem duplicar atribuições
+        e sem esperar uns pelos outros. Retorna {user_id: [ids dos leads]}.
+        """
+        self.env.flush_all()
+        cr = self.env.cr
+        cr.execute("""
+            SELECT id FROM crm_lead
+             WHERE queue_dispatch
+               AND user_id IS NULL
+               AND active
+               AND COALESCE(probability, 0) < 100
+          ORDER BY create_date, id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, (batch_size,))
+        lead_ids = [row[0] for row in cr.fetchall()]
+        if not lead_ids:
+            return {}
+
+        # Quem está há mais tempo sem receber lead vem primeiro
+        cr.execute("""
+            SELECT q.id, q.user_id
+              FROM crm_sales_unit_queue q
+              JOIN res_users u ON u.id = q.user_id
+             WHERE q.active
+               AND q.date = %s
+               AND u.active
+          ORDER BY q.last_assigned_at NULLS FIRST, q.checkin_time, q.id
+             LIMIT %s
+               FOR UPDATE OF q SKIP LOCKED
+        """, (fields.Date.context_today(self), len(lead_ids)))
+        brokers = cr.fetchall()
+        if not brokers:
+            return {}
+
+        assignments = defaultdict(list)
+        for index, lead_id in enumerate(lead_ids):
+            assignments[brokers[index % len(brokers)]].append(lead_id)
+
+        # Uma escrita de leads e uma da fila por corretor
+        Lead = self.env["crm.lead"].sudo()
+        now = fields.Datetime.now()
+        result = {}
+        for (queue_id, user_id), broker_lead_ids in assignments.items():
+            Lead.browse(broker_lead_ids).write({"user_id": user_id, "queue_dispatch": False})
+            queue = self.sudo().browse(queue_id)
+            queue.write({
+                "last_assigned_at": now,
+                "assigned_count": queue.assigned_count + len(broker_lead_ids),
+            })
+            result[user_id] = broker_lead_ids
+
+        _logger.info("Distribuição de leads: %s leads para %s corretores", len(lead_ids), len(result))
+        return result
+
+    @api.model
+    def _cron_dispatch_leads(self, batch_size=DISPATCH_BATCH_SIZE, auto_commit=False):
+        """Distribui em rodadas até acabarem os leads livres ou os corretores disponíveis"""
+        if not self.env["crm.sales.unit.config"]._is_dispatch_enabled():
+            return 0
+        total = 0
+        while True:
+            result = self._dispatch_leads(batch_size)
+            assigned = sum(len(ids) for ids in result.values())
+            total += assigned
+            if auto_commit:
+                self.env.cr.commit()
+            if assigned < batch_size:
+                break
+        return total
+
 
 # ---------------------------------------------------------
 # Auditoria em hr.attendance (dados extras de check-in/out)
@@ -83,6 +258,35 @@ class HRAttendance(models.Model):
     check_out_location_id = fields.Many2one("crm.sales.unit.location", string="Localização Validada (Check-out)")
     check_out_distance_from_location = fields.Float(string="Distância do Check-out ao Local Validado (m)")
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        attendances = super().create(vals_list)
+        attendances.filtered("check_out")._evict_queue_on_checkout()
+        return attendances
+
+    def write(self, vals):
+        res = super().write(vals)
+        if vals.get("check_out"):
+            self._evict_queue_on_checkout()
+        return res
+
+    def _evict_queue_on_checkout(self):
+        """Tira da fila, na mesma transação, quem ficou sem attendance aberto"""
+        employees = self.employee_id
+        if not employees:
+            return
+        still_open = self.sudo().search([
+            ("employee_id", "in", employees.ids),
+            ("check_out", "=", False),
+        ]).employee_id
+        queue = self.env["crm.sales.unit.queue"].sudo().search([
+            ("employee_id", "in", (employees - still_open).ids),
+            ("active", "=", True),
+        ])
+        if queue:
+            _logger.info("Funcionários removidos da fila no checkout: %s", ", ".join(queue.employee_id.mapped("name")))
+            queue.unlink()
+
 
 # ---------------------------------------------------------
 # Helpers em hr.employee (sem sobrescrever nativos)
@@ -128,8 +332,8 @@ class HREmployee(models.Model):
         client_ip = self._get_client_ip()
         ctx['client_ip'] = client_ip
 
-        ip_recs = self.env['crm.sales.unit.ip'].search([])
-        if ip_recs:  # só valida se houver ranges configurados
+        IPRange = self.env['crm.sales.unit.ip']
+        if IPRange._has_ranges():  # só valida se houver ranges configurados
             if not client_ip:
                 _logger.warning("Check-in NEGADO: IP do cliente não identificado.")
                 raise ValidationError(_("Check-in negado. Não foi possível identificar seu IP."))
@@ -138,14 +342,11 @@ class HREmployee(models.Model):
             except ValueError:
                 _logger.warning("Check-in NEGADO: IP inválido detectado (%s).", client_ip)
                 raise ValidationError(_("IP inválido detectado (%s).") % client_ip)
-            matched = False
-            for ip_rec in ip_recs:
-                if ip_obj in ipaddress.ip_network(ip_rec.cidr, strict=False):
-                    ctx['validated_ip_rec'] = ip_rec
-                    matched = True
-                    _logger.info("IP VALIDADO: %s dentro do range %s", client_ip, ip_rec.cidr)
-                    break
-            if not matched:
+            ip_rec = IPRange._match_ip(ip_obj)
+            if ip_rec:
+                ctx['validated_ip_rec'] = ip_rec
+                _logger.info("IP VALIDADO: %s dentro do range id %s", client_ip, ip_rec.id)
+            else:
                 _logger.warning("Check-in NEGADO: IP %s fora de todos os ranges permitidos.", client_ip)
                 raise ValidationError(_("Check-in negado. Seu IP (%s) não está em nenhum range permitido.") % client_ip)
 
@@ -209,12 +410,35 @@ class CRMSalesUnitConfig(models.Model):
 
     start_time = fields.Float(string="Início do Expediente", required=True, digits=(16, 2), default=13.0)
     end_time = fields.Float(string="Fim do Expediente", required=True, digits=(16, 2), default=21.0)
+    lead_dispatch_enabled = fields.Boolean(
+        string="Distribuir Leads pela Fila",
+        default=False,
+        help="Leads criados sem corretor a partir de agora são distribuídos entre os corretores da fila."
+    )
 
     @api.model_create_multi
     def create(self, vals_list):
         if self.search([]):
             raise ValidationError(_("Já existe uma configuração de expediente. Edite a existente."))
-        return super().create(vals_list)
+        configs = super().create(vals_list)
+        configs._sync_dispatch_cron()
+        return configs
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "lead_dispatch_enabled" in vals:
+            self._sync_dispatch_cron()
+        return res
+
+    def _sync_dispatch_cron(self):
+        """O cron de distribuição só fica ativo com a distribuição habilitada"""
+        cron = self.env.ref("crm_sales_unit.cron_dispatch_leads", raise_if_not_found=False)
+        if cron:
+            cron.sudo().active = any(self.mapped("lead_dispatch_enabled"))
+
+    @api.model
+    def _is_dispatch_enabled(self):
+        return bool(self.sudo().search([], limit=1).lead_dispatch_enabled)
 
     @api.model
     def get_config(self):
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+from odoo import models, fields, api
+
+# Sequência da versão da hierarquia: nextval não trava nada entre transações
+VERSION_SEQUENCE = "crm_sales_unit_hierarchy_version_seq"
+# Chave em cr.postcommit.data com as mudanças ainda não commitadas da transação
+PENDING_CHANGES_KEY = "crm_sales_unit.hierarchy_pending_changes"
+
+
+class CRMSalesUnitHierarchyLog(models.Model):
+    """Log compacto de mudanças na hierarquia.
+
+    A versão vem de uma sequência do Postgres, sem trava de linha: cada log
+    recebe um nextval e, depois do commit, a versão é incrementada de novo,
+    de modo que os caches de autorização e do organograma (chaveados pela
+    versão) só passam a uma nova chave quando a mudança já está visível.
+    Como a ordem das versões não é a ordem de commit, cada log guarda também
+    o id da transação (xact_id): os jobs de visibilidade comparam esse id com
+    o snapshot tirado ao enfileirar para saber o que mudou depois deles.
+    """
+    _name = "crm.sales.unit.hierarchy.log"
+    _description = "Log de Alterações da Hierarquia de Vendas"
+    _order = "version desc, id desc"
+
+    version = fields.Integer(string="Versão", readonly=True, index=True)
+    change_type = fields.Selection(
+        [
+            ("unit_create", "Criação de Unidade"),
+            ("unit_write", "Alteração de Unidade"),
+            ("unit_archive", "Arquivamento de Unidade"),
+            ("user_create", "Criação de Usuário"),
+            ("user_write", "Alteração de Usuário"),
+            ("user_archive", "Arquivamento de Usuário"),
+        ],
+        string="Tipo de Alteração",
+        required=True,
+        readonly=True
+    )
+    changed_fields = fields.Char(string="Campos Alterados", readonly=True)
+    unit_ids = fields.Many2many(
+        "crm.sales.unit",
+        "crm_sales_unit_hierarchy_log_unit_rel",
+        "log_id",
+        "unit_id",
+        string="Unidades Afetadas",
+        readonly=True
+    )
+    user_ids = fields.Many2many(
+        "res.users",
+        "crm_sales_unit_hierarchy_log_user_rel",
+        "log_id",
+        "user_id",
+        string="Usuários Afetados",
+        readonly=True
+    )
+    change_date = fields.Datetime(string="Data", default=lambda self: fields.Datetime.now(), readonly=True)
+    author_id = fields.Many2one(
+        "res.users", string="Autor", default=lambda self: self.env.user, readonly=True
+    )
+
+    def init(self):
+        cr = self.env.cr
+        cr.execute(f"CREATE SEQUENCE IF NOT EXISTS {VERSION_SEQUENCE}")
+        cr.execute(f"""
+            SELECT setval('{VERSION_SEQUENCE}', GREATEST(
+                (SELECT last_value FROM {VERSION_SEQUENCE}),
+                (SELECT COALESCE(MAX(version), 0) + 1 FROM crm_sales_unit_hierarchy_log)
+            ))
+        """)
+        # Transação (id de topo, mesmo dentro de savepoints) que gravou o log
+        cr.execute("""
+            ALTER TABLE crm_sales_unit_hierarchy_log
+                ADD COLUMN IF NOT EXISTS xact_id BIGINT NOT NULL DEFAULT txid_current();
+            CREATE INDEX IF NOT EXISTS crm_sales_unit_hierarchy_log_xact_id_idx
+                ON crm_sales_unit_hierarchy_log (xact_id)
+        """)
+
+    @api.model
+    def _get_hierarchy_version(self):
+        """Versão atual da hierarquia (lida da sequência, sem trava)"""
+        self.env.cr.execute(f"SELECT last_value FROM {VERSION_SEQUENCE}")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_hierarchy_cache_key(self):
+        """Chave dos caches que dependem da hierarquia.
+
+        Com mudanças ainda não commitadas nesta transação, a chave inclui um
+        token próprio da transação: ela enxerga as próprias mudanças sem
+        reaproveitar, nem deixar para os outros, entradas com dados não commitados.
+        """
+        version = self._get_hierarchy_version()
+        pending = self.env.cr.postcommit.data.get(PENDING_CHANGES_KEY)
+        if pending:
+            return (version, pending["token"], pending["count"])
+        return version
+
+    @api.model
+    def _get_hierarchy_snapshot(self):
+        """Snapshot das transações visíveis agora, para comparar com xact_id"""
+        self.env.cr.execute("SELECT txid_current_snapshot()::text")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_changes_since(self, snapshot):
+        """Logs de transações que não estavam commitadas no snapshot informado"""
+        self.flush_model()
+        self.env.cr.execute("""
+            SELECT id FROM crm_sales_unit_hierarchy_log
+             WHERE xact_id >= txid_snapshot_xmin(%(snapshot)s::txid_snapshot)
+               AND NOT txid_visible_in_snapshot(xact_id, %(snapshot)s::txid_snapshot)
+        """, {"snapshot": snapshot})
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    @api.model
+    def _log_change(self, change_type, units=None, users=None, changed_fields=()):
+        """Registra a mudança; a nova versão da hierarquia vale a partir do commit"""
+        cr = self.env.cr
+        cr.execute(f"SELECT nextval('{VERSION_SEQUENCE}')")
+        log = self.sudo().create({
+            "version": cr.fetchone()[0],
+            "change_type": change_type,
+            "changed_fields": ",".join(sorted(changed_fields)) or False,
+            "unit_ids": [(6, 0, units.ids)] if units else False,
+            "user_ids": [(6, 0, users.ids)] if users else False,
+        })
+        log.flush_recordset()
+
+        pending = cr.postcommit.data.setdefault(PENDING_CHANGES_KEY, {"token": uuid.uuid4().hex, "count": 0})
+        pending["count"] += 1
+        cr.postcommit.add(self._bump_hierarchy_version)
+        return log
+
+    @api.model
+    def _bump_hierarchy_version(self):
+        """Depois do commit: nova chave para os caches, já com a mudança visível"""
+        self.env.cr.execute(f"SELECT nextval('{VERSION_SEQUENCE}')")
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, _
+from odoo.exceptions import UserError
+
+
+class CRMSalesUnitTransferLog(models.Model):
+    _name = "crm.sales.unit.transfer.log"
+    _description = "Log de Reorganização de Unidades de Vendas"
+    _order = "done_date desc, id desc"
+
+    operation = fields.Selection(
+        [
+            ("members", "Transferência de Corretores"),
+            ("subtree", "Movimentação de Unidade"),
+        ],
+        string="Operação",
+        required=True,
+        readonly=True
+    )
+    unit_id = fields.Many2one("crm.sales.unit", string="Unidade Movida", readonly=True)
+    source_unit_ids = fields.Many2many(
+        "crm.sales.unit",
+        "crm_sales_unit_transfer_log_source_rel",
+        "log_id",
+        "unit_id",
+        string="Unidades de Origem",
+        readonly=True
+    )
+    target_unit_id = fields.Many2one("crm.sales.unit", string="Unidade de Destino", required=True, readonly=True)
+    user_ids = fields.Many2many(
+        "res.users",
+        "crm_sales_unit_transfer_log_user_rel",
+        "log_id",
+        "user_id",
+        string="Corretores Movidos",
+        readonly=True
+    )
+    user_count = fields.Integer(string="Qtd. Corretores", readonly=True)
+    done_date = fields.Datetime(string="Data da Ação", default=lambda self: fields.Datetime.now(), readonly=True)
+    executor_id = fields.Many2one(
+        "res.users", string="Executor", required=True, default=lambda self: self.env.user, readonly=True
+    )
+
+
+class CRMSalesUnitTransferWizard(models.TransientModel):
+    _name = "crm.sales.unit.transfer.wizard"
+    _description = "Reorganização de Unidades de Vendas"
+
+    operation = fields.Selection(
+        [
+            ("members", "Transferir corretores para uma unidade"),
+            ("subtree", "Mover unidade (com subunidades) para outra unidade superior"),
+        ],
+        string="Operação",
+        required=True,
+        default="members"
+    )
+    user_ids = fields.Many2many("res.users", string="Corretores")
+    unit_id = fields.Many2one("crm.sales.unit", string="Unidade a Mover")
+    target_unit_id = fields.Many2one("crm.sales.unit", string="Unidade de Destino", required=True)
+
+    def action_apply(self):
+        self.ensure_one()
+        if self.operation == "members":
+            if not self.user_ids:
+                raise UserError(_("Selecione os corretores a transferir."))
+            log = self.target_unit_id.action_transfer_members(self.user_ids)
+        else:
+            if not self.unit_id:
+                raise UserError(_("Selecione a unidade a mover."))
+            log = self.unit_id.action_move_subtree(self.target_unit_id)
+
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Reorganização concluída'),
+                'message': _("%s: %s corretor(es) afetado(s).") % (
+                    dict(log._fields['operation'].selection)[log.operation], log.user_count
+                ),
+                'sticky': False,
+            }
+        }
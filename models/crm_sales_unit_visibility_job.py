@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# Acima deste número de usuários afetados, o recálculo de visibilidade vai para segundo plano
+SYNC_THRESHOLD_PARAM = "crm_sales_unit.visibility_sync_threshold"
+DEFAULT_SYNC_THRESHOLD = 200
+DEFAULT_CHUNK_SIZE = 500
+
+
+class CRMSalesUnitVisibilityJob(models.Model):
+    """Recálculo de allowed_user_ids em lotes, fora da requisição HTTP.
+
+    Os pares (usuário, visível) são preparados por lote em uma tabela de
+    trabalho, com commit a cada lote; a tabela res_users_allowed_rel só é
+    trocada no final, em uma transação, então os leitores nunca veem um
+    estado parcial.
+    """
+    _name = "crm.sales.unit.visibility.job"
+    _description = "Recálculo de Visibilidade em Segundo Plano"
+    _order = "id desc"
+
+    state = fields.Selection(
+        [
+            ("pending", "Pendente"),
+            ("running", "Em Andamento"),
+            ("done", "Concluído"),
+        ],
+        string="Status",
+        default="pending",
+        required=True,
+        readonly=True
+    )
+    user_ids = fields.Many2many(
+        "res.users",
+        "crm_sales_unit_visibility_job_user_rel",
+        "job_id",
+        "user_id",
+        string="Usuários a Recalcular",
+        readonly=True
+    )
+    total_count = fields.Integer(string="Total de Usuários", readonly=True)
+    processed_count = fields.Integer(string="Processados", readonly=True)
+    progress = fields.Float(string="Progresso", compute="_compute_progress")
+    last_user_id = fields.Integer(string="Último Usuário Processado", readonly=True)
+    hierarchy_snapshot = fields.Char(string="Snapshot da Hierarquia", readonly=True)
+    requested_by = fields.Many2one(
+        "res.users", string="Solicitado por", default=lambda self: self.env.user, readonly=True
+    )
+    date_start = fields.Datetime(string="Início", readonly=True)
+    date_done = fields.Datetime(string="Conclusão", readonly=True)
+
+    def init(self):
+        # Pares preparados pelo job, aplicados de uma vez na troca final
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS crm_sales_unit_visibility_stage (
+                job_id INTEGER NOT NULL REFERENCES crm_sales_unit_visibility_job(id) ON DELETE CASCADE,
+                user_id INTEGER NOT NULL,
+                allowed_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS crm_sales_unit_visibility_stage_job_idx
+                ON crm_sales_unit_visibility_stage (job_id)
+        """)
+
+    @api.depends("processed_count", "total_count")
+    def _compute_progress(self):
+        for job in self:
+            job.progress = 100.0 * job.processed_count / job.total_count if job.total_count else 0.0
+
+    @api.model
+    def _get_sync_threshold(self):
+        return int(self.env["ir.config_parameter"].sudo().get_param(SYNC_THRESHOLD_PARAM, DEFAULT_SYNC_THRESHOLD))
+
+    @api.model
+    def _enqueue(self, users):
+        """Agenda o recálculo da visibilidade dos usuários e acorda o cron"""
+        job = self.sudo().create({
+            "user_ids": [(6, 0, users.ids)],
+            "total_count": len(users),
+            "hierarchy_snapshot": self.env["crm.sales.unit.hierarchy.log"]._get_hierarchy_snapshot(),
+        })
+        self.env.ref("crm_sales_unit.cron_visibility_jobs")._trigger()
+        _logger.info("Recálculo de visibilidade de %s usuários agendado (job %s)", len(users), job.id)
+        return job
+
+    # ======================================================
+    # PROCESSAMENTO EM LOTES (CRON)
+    # ======================================================
+    @api.model
+    def _cron_process_jobs(self, chunk_size=DEFAULT_CHUNK_SIZE, auto_commit=False):
+        for job in self.search([("state", "in", ("pending", "running"))], order="id"):
+            job._process(chunk_size, auto_commit)
+
+    def _process(self, chunk_size=DEFAULT_CHUNK_SIZE, auto_commit=False):
+        """Retoma o job a partir de last_user_id; ao final, troca a visibilidade de uma vez"""
+        self.ensure_one()
+        cr = self.env.cr
+        Users = self.env["res.users"].sudo()
+        if self.state == "pending":
+            self.write({"state": "running", "date_start": fields.Datetime.now()})
+
+        while True:
+            cr.execute("""
+                SELECT user_id FROM crm_sales_unit_visibility_job_user_rel
+                 WHERE job_id = %s AND user_id > %s
+              ORDER BY user_id
+                 LIMIT %s
+            """, (self.id, self.last_user_id, chunk_size))
+            chunk_ids = [row[0] for row in cr.fetchall()]
+            if not chunk_ids:
+                break
+
+            allowed_map = Users.browse(chunk_ids)._get_allowed_user_map()
+            pairs = [(user_id, allowed_id) for user_id in chunk_ids for allowed_id in allowed_map[user_id]]
+            cr.execute("""
+                INSERT INTO crm_sales_unit_visibility_stage (job_id, user_id, allowed_id)
+                SELECT %s, unnest(%s::int[]), unnest(%s::int[])
+            """, (self.id, [p[0] for p in pairs], [p[1] for p in pairs]))
+            self.write({
+                "last_user_id": chunk_ids[-1],
+                "processed_count": self.processed_count + len(chunk_ids),
+            })
+            if auto_commit:
+                cr.commit()
+            self.env.invalidate_all()
+
+        # Mudanças na hierarquia durante o job: só os usuários do job afetados por
+        # elas têm pares possivelmente obsoletos; o restante é trocado normalmente
+        stale = Users
+        if self.hierarchy_snapshot:
+            changes = self.env["crm.sales.unit.hierarchy.log"].sudo()._get_changes_since(self.hierarchy_snapshot)
+            stale = changes.user_ids
+            if changes.unit_ids:
+                stale |= Users._get_hierarchy_affected_users(changes.unit_ids)
+            stale &= self.user_ids
+
+        # Troca final em uma única transação
+        cr.execute("""
+            DELETE FROM res_users_allowed_rel
+             WHERE user_id IN (
+                SELECT user_id FROM crm_sales_unit_visibility_job_user_rel WHERE job_id = %(job)s
+             );
+            INSERT INTO res_users_allowed_rel (user_id, allowed_id)
+            SELECT DISTINCT user_id, allowed_id FROM crm_sales_unit_visibility_stage WHERE job_id = %(job)s;
+            DELETE FROM crm_sales_unit_visibility_stage WHERE job_id = %(job)s;
+        """, {"job": self.id})
+        Users.invalidate_model(["allowed_user_ids"])
+        self.write({"state": "done", "date_done": fields.Datetime.now()})
+        if auto_commit:
+            cr.commit()
+        _logger.info("Recálculo de visibilidade concluído: job %s, %s usuários", self.id, self.total_count)
+
+        # Recalcula (ou agenda) apenas a diferença, na versão atual da hierarquia
+        if stale:
+            stale._refresh_allowed_user_ids()
+        return True
@@ -0,0 +1,122 @@
+from odoo import models, fields, api, tools
+
+# Funil padrão usado apenas para configurar os estágios na instalação:
+# (nome, ignorado na expansão de intermediárias, exibido no painel do funil)
+DEFAULT_FUNNEL_STAGES = [
+    ("Novo", False, True),
+    ("Primeiro Contato", False, True),
+    ("Qualificando", False, True),
+    ("Agendado", False, True),
+    ("Reagendar", True, False),
+    ("Preparando Pasta", False, False),
+    ("Pasta completa", False, False),
+    ("Análise", False, True),
+    ("Aprovado", False, True),
+    ("Reprovado", True, False),
+    ("Fluxo Agendado", False, False),
+    ("Aguardando Retorno", False, False),
+    ("Venda Fechada", False, True),
+    ("Repasse", False, False),
+]
+
+FUNNEL_FIELDS = {"name", "sequence", "funnel_sequence", "funnel_skip", "funnel_dashboard"}
+
+
+class CrmStage(models.Model):
+    _inherit = "crm.stage"
+
+    funnel_sequence = fields.Integer(
+        string="Posição no Funil",
+        default=0,
+        help="Ordem do estágio no funil de vendas. Zero deixa o estágio fora do funil."
+    )
+    funnel_skip = fields.Boolean(
+        string="Ignorar na Expansão do Funil",
+        help="Não gera histórico quando o lead pula este estágio (ex.: Reprovado, Reagendar)."
+    )
+    funnel_dashboard = fields.Boolean(
+        string="Exibir no Painel do Funil"
+    )
+
+    # ======================================================
+    # RESOLUÇÃO DE ESTÁGIOS POR NOME (CACHE DO REGISTRY)
+    # ======================================================
+    @api.model
+    @tools.ormcache('self.env.lang')
+    def _get_stage_ids_by_name(self):
+        """Mapa nome → id do primeiro estágio com esse nome (mesma ordem do search)"""
+        stage_ids = {}
+        for stage in self.sudo().search_fetch([], ['name']):
+            stage_ids.setdefault(stage.name, stage.id)
+        return stage_ids
+
+    @api.model
+    def _get_stage_by_name(self, name):
+        """Equivalente em cache a search([('name', '=', name)], limit=1)"""
+        return self.browse(self._get_stage_ids_by_name().get(name))
+
+    # ======================================================
+    # DEFINIÇÃO DO FUNIL (TABELA DE TRANSIÇÕES EM CACHE)
+    # ======================================================
+    @api.model
+    @tools.ormcache()
+    def _get_funnel_transitions(self):
+        """Tabela (origem, destino) → ids dos estágios intermediários, para avanços no funil"""
+        funnel = self.sudo().search_fetch(
+            [("funnel_sequence", ">", 0)],
+            ["funnel_sequence", "funnel_skip"],
+            order="funnel_sequence, id",
+        )
+        positions = [(stage.id, stage.funnel_sequence, stage.funnel_skip) for stage in funnel]
+
+        transitions = {}
+        for origin_id, origin_seq, _skip in positions:
+            for dest_id, dest_seq, _skip in positions:
+                if dest_seq > origin_seq:
+                    transitions[(origin_id, dest_id)] = tuple(
+                        stage_id for stage_id, seq, skip in positions
+                        if origin_seq < seq < dest_seq and not skip
+                    )
+        return transitions
+
+    @api.model
+    @tools.ormcache('self.env.lang')
+    def _get_funnel_dashboard_stages(self):
+        """Estágios exibidos no painel, na ordem do funil: tupla de (id, nome)"""
+        stages = self.sudo().search_fetch(
+            [("funnel_sequence", ">", 0), ("funnel_dashboard", "=", True)],
+            ["name"],
+            order="funnel_sequence, id",
+        )
+        return tuple((stage.id, stage.name) for stage in stages)
+
+    @api.model
+    def _init_funnel_stages(self):
+        """Configura o funil padrão pelos nomes, se nenhum estágio estiver no funil ainda"""
+        if self.sudo().search_count([("funnel_sequence", ">", 0)], limit=1):
+            return
+        stage_ids = self._get_stage_ids_by_name()
+        for position, (name, skip, dashboard) in enumerate(DEFAULT_FUNNEL_STAGES, start=1):
+            if name in stage_ids:
+                self.sudo().browse(stage_ids[name]).write({
+                    "funnel_sequence": position * 10,
+                    "funnel_skip": skip,
+                    "funnel_dashboard": dashboard,
+                })
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        stages = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return stages
+
+    def write(self, vals):
+        res = super().write(vals)
+        if FUNNEL_FIELDS & set(vals):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
@@ -82,11 +82,15 @@ class HREmployee(models.Model):
 
         if attendance and not attendance.check_out and now_utc < start_dt_utc:
             queue_date = fields.Date.context_today(self)
-            queue = self.env['crm.sales.unit.queue'].search([
+            # Inclui entradas inativas: só pode haver uma por funcionário e data
+            queue = self.env['crm.sales.unit.queue'].with_context(active_test=False).search([
                 ('employee_id', '=', self.id),
                 ('date', '=', queue_date)
             ], limit=1)
-            if not queue:
+            if queue and not queue.active:
+                queue.write({'active': True})
+                _logger.info("Funcionário %s voltou para a fila de leads", self.name)
+            elif not queue:
                 self.env['crm.sales.unit.queue'].create({
                     'user_id': self.user_id.id,
                     'employee_id': self.id,
@@ -96,15 +100,7 @@ class HREmployee(models.Model):
                 })
                 _logger.info("Funcionário %s entrou na fila de leads", self.name)
 
-        elif attendance and attendance.check_out:
-            queue = self.env['crm.sales.unit.queue'].search([
-                ('employee_id', '=', self.id),
-                ('active', '=', True)
-            ])
-            if queue:
-                queue.unlink()
-                _logger.info("Funcionário %s removido da fila no checkout", self.name)
-
+        # A saída da fila no checkout é feita pelo próprio hr.attendance
         return res
 
     # ======================================================
@@ -134,35 +130,52 @@ class HREmployee(models.Model):
         nine_local = now_local.replace(hour=9, minute=0, second=0, microsecond=0)
         nine_utc = nine_local.astimezone(pytz.UTC).replace(tzinfo=None)
 
-        employees = self.search([('user_id', '!=', False)])
         queue_date = fields.Date.context_today(self)
 
-        for emp in employees:
-            att = self.env['hr.attendance'].search([
-                ('employee_id', '=', emp.id),
-                ('check_out', '=', False)
-            ], order='check_in desc', limit=1)
-
-            if not att:
-                continue
-
-            # regra: logou depois das 9h locais e antes do início do expediente
-            if att.check_in >= nine_utc and att.check_in < start_dt_utc:
-                queue = self.env['crm.sales.unit.queue'].search([
-                    ('employee_id', '=', emp.id),
-                    ('date', '=', queue_date)
-                ], limit=1)
-                if not queue:
-                    self.env['crm.sales.unit.queue'].create({
-                        'user_id': emp.user_id.id,
-                        'employee_id': emp.id,
-                        'checkin_time': att.check_in,
-                        'date': queue_date,
-                        'active': True,
-                    })
-                    _logger.info("Funcionário %s colocado na fila pelo cron", emp.name)
-
-
+        # Uma única consulta: último attendance aberto de cada funcionário, dentro da
+        # janela [9h, início do expediente), sem entrada ativa na fila hoje. Quem saiu
+        # da fila (entrada inativa) e fez check-in de novo é reativado pelo ON CONFLICT
+        # (único por funcionário/data), que também mantém a execução idempotente.
+        Queue = self.env['crm.sales.unit.queue']
+        self.env.flush_all()
+        self.env.cr.execute("""
+            INSERT INTO crm_sales_unit_queue
+                   (user_id, employee_id, checkin_time, date, active,
+                    create_uid, create_date, write_uid, write_date)
+            SELECT att.user_id, att.employee_id, att.check_in, %(date)s, TRUE,
+                   %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM (
+                    SELECT DISTINCT ON (a.employee_id) a.employee_id, e.user_id, a.check_in
+                      FROM hr_attendance a
+                      JOIN hr_employee e ON e.id = a.employee_id
+                     WHERE a.check_out IS NULL
+                       AND e.active
+                       AND e.user_id IS NOT NULL
+                  ORDER BY a.employee_id, a.check_in DESC
+                   ) att
+             WHERE att.check_in >= %(nine)s
+               AND att.check_in < %(start)s
+               AND NOT EXISTS (
+                    SELECT 1 FROM crm_sales_unit_queue q
+                     WHERE q.employee_id = att.employee_id AND q.date = %(date)s AND q.active
+               )
+            ON CONFLICT (employee_id, date) DO UPDATE
+                SET active = TRUE,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date
+              WHERE NOT crm_sales_unit_queue.active
+            RETURNING employee_id
+        """, {
+            'date': queue_date,
+            'uid': self.env.uid,
+            'nine': nine_utc,
+            'start': start_dt_utc,
+        })
+        added_ids = [row[0] for row in self.env.cr.fetchall()]
+        if added_ids:
+            Queue.invalidate_model()
+            _logger.info("Cron colocou (ou reativou) %s funcionários na fila: %s", len(added_ids), added_ids)
+        return len(added_ids)
 
     # ======================================================
     # FORÇAR CHECK-OUT MANUALMENTE
@@ -172,32 +185,33 @@ class HREmployee(models.Model):
         """Permite que gestores façam checkout manual dos subordinados"""
         user = self.env.user
         # Apenas coordenador, gerente, diretor ou presidente podem usar
-        if not (user.has_group("crm_sales_unit.group_coordinator") or
-                user.has_group("crm_sales_unit.group_manager") or
-                user.has_group("crm_sales_unit.group_director") or
-                user.has_group("crm_sales_unit.group_president")):
+        if not self.env["res.users"]._get_hierarchy_auth(self.env.uid).role:
             raise ValidationError(_("Você não tem permissão para forçar checkout de funcionários."))
 
         now_utc = fields.Datetime.now()
-        today = fields.Date.context_today(self)  # usa data local
 
-        for emp in self:
-            attendance = self.env['hr.attendance'].search([
-                ('employee_id', '=', emp.id),
-                ('check_out', '=', False),
-                ('check_in', '>=', today)
-            ], limit=1)
-            if attendance:
-                attendance.write({'check_out': now_utc})
-                _logger.info("Checkout manual forçado por gestor [%s] para funcionário [%s]", user.name, emp.name)
-
-            queue = self.env['crm.sales.unit.queue'].search([
-                ('employee_id', '=', emp.id),
-                ('active', '=', True),
-            ])
-            if queue:
-                queue.unlink()
-                _logger.info("Funcionário %s removido da fila no checkout", self.name)
+        # Todos os attendances abertos, inclusive os esquecidos de dias anteriores
+        # (como no checkout de fim de expediente)
+        attendances = self.env['hr.attendance'].search([
+            ('employee_id', 'in', self.ids),
+            ('check_out', '=', False),
+        ])
+        if attendances:
+            # O checkout remove os funcionários da fila (hr.attendance.write)
+            attendances.write({'check_out': now_utc})
+            _logger.info(
+                "Checkout manual forçado por gestor [%s] para funcionários [%s]",
+                user.name, ", ".join(attendances.employee_id.mapped("name"))
+            )
+
+        # Saída explícita da fila: cobre quem ficou na fila sem attendance aberto
+        queue = self.env['crm.sales.unit.queue'].sudo().search([
+            ('employee_id', 'in', self.ids),
+            ('active', '=', True),
+        ])
+        if queue:
+            _logger.info("Funcionários removidos da fila pelo gestor: %s", ", ".join(queue.employee_id.mapped("name")))
+            queue.unlink()
 
 
     # ======================================================
@@ -219,46 +233,41 @@ class HREmployee(models.Model):
         end_dt_local = now_local.replace(hour=end_hour, minute=end_min, second=0, microsecond=0)
         end_dt_utc = end_dt_local.astimezone(pytz.UTC).replace(tzinfo=None)
 
-        employees = self.search([('user_id', '!=', False)])
-
-        for emp in employees:
-            attendance = self.env['hr.attendance'].search([
-                ('employee_id', '=', emp.id),
-                ('check_out', '=', False)
-            ], limit=1)
-
-            if not attendance:
-                continue
+        # Uma leitura de todos os attendances abertos; regras avaliadas em memória
+        open_attendances = self.env['hr.attendance'].search_fetch([
+            ('check_out', '=', False),
+            ('employee_id.user_id', '!=', False),
+        ], ['check_in', 'employee_id'])
 
+        summary = {'previous_day': 0, 'before_nine': 0, 'end_of_shift': 0, 'still_open': 0, 'queue_removed': 0}
+        close_ids = []
+        for attendance in open_attendances:
             checkin_date = attendance.check_in.date()
-            checkin_hour = attendance.check_in.hour
 
             # Regras de checkout
             if checkin_date < today:
-                attendance.write({'check_out': now_utc})
-                _logger.info("Checkout forçado (dia anterior) para %s", emp.name)
-
-            elif checkin_date == today and checkin_hour < 9:
-                attendance.write({'check_out': now_utc})
-                _logger.info("Checkout forçado (antes das 9h) para %s", emp.name)
-
+                summary['previous_day'] += 1
+            elif checkin_date == today and attendance.check_in.hour < 9:
+                summary['before_nine'] += 1
             elif now_utc >= end_dt_utc:
-                attendance.write({'check_out': now_utc})
-                _logger.info("Checkout forçado (fim do expediente) para %s", emp.name)
-
+                summary['end_of_shift'] += 1
             else:
-                _logger.info("Funcionário %s continua logado (expediente ativo)", emp.name)
+                summary['still_open'] += 1
+                continue
+            close_ids.append(attendance.id)
 
-            # limpar fila
+        to_close = open_attendances.browse(close_ids)
+        if to_close:
             queue = self.env['crm.sales.unit.queue'].search([
-                ('employee_id', '=', emp.id),
+                ('employee_id', 'in', to_close.employee_id.ids),
                 ('active', '=', True)
             ])
-            if queue and (checkin_date < today or checkin_hour < 9 or now_utc >= end_dt_utc):
-                queue.unlink()
-                _logger.info("Funcionário %s removido da fila", emp.name)
-
+            # Um write para todos os attendances; a fila é esvaziada pelo hook de checkout
+            to_close.write({'check_out': now_utc})
+            summary['queue_removed'] = len(queue) - len(queue.exists())
 
+        _logger.info("Checkout de fim de expediente: %s", summary)
+        return summary
 
 
     # ======================================================
@@ -268,12 +277,20 @@ class HREmployee(models.Model):
         """Permite ao presidente colocar manualmente funcionário na fila"""
         if not self.env.user.has_group("crm_sales_unit.group_president"):
             raise ValidationError(_("Apenas o presidente pode adicionar manualmente funcionários à fila."))
-        self.env['crm.sales.unit.queue'].create({
-            'user_id': self.user_id.id,
-            'employee_id': self.id,
-            'checkin_time': fields.Datetime.now(),
-            'date': fields.Date.today(),
-        })
+        # Uma entrada por funcionário e data: reativa a existente em vez de duplicar
+        queue = self.env['crm.sales.unit.queue'].with_context(active_test=False).search([
+            ('employee_id', '=', self.id),
+            ('date', '=', fields.Date.today()),
+        ], limit=1)
+        if queue:
+            queue.write({'active': True})
+        else:
+            self.env['crm.sales.unit.queue'].create({
+                'user_id': self.user_id.id,
+                'employee_id': self.id,
+                'checkin_time': fields.Datetime.now(),
+                'date': fields.Date.today(),
+            })
         _logger.info("Funcionário %s adicionado manualmente à fila pelo presidente", self.name)
 
     
@@ -288,18 +305,26 @@ class HREmployee(models.Model):
 
     #Remove da fila quem fez checkout
     def cleanup_queue_after_checkout(self):
-        """Remove da fila quem já fez checkout"""
-        now_utc = fields.Datetime.now()
-        queues = self.env['crm.sales.unit.queue'].search([('active', '=', True)])
-        for q in queues:
-            # procura se existe attendance aberto para o funcionário
-            attendance_open = self.env['hr.attendance'].search([
-                ('employee_id', '=', q.employee_id.id),
-                ('check_out', '=', False)
-            ], limit=1)
-            if not attendance_open:
-                q.unlink()
-                _logger.info("Funcionário %s removido da fila (checkout detectado)", q.employee_id.name)
+        """Varredura de consistência: remove da fila quem não tem attendance aberto.
+
+        O checkout já tira o funcionário da fila na mesma transação; esta
+        varredura só cobre alterações feitas fora do ORM.
+        """
+        self.env.flush_all()
+        self.env.cr.execute("""
+            DELETE FROM crm_sales_unit_queue q
+             WHERE q.active
+               AND NOT EXISTS (
+                    SELECT 1 FROM hr_attendance a
+                     WHERE a.employee_id = q.employee_id AND a.check_out IS NULL
+               )
+         RETURNING q.employee_id
+        """)
+        removed = [row[0] for row in self.env.cr.fetchall()]
+        if removed:
+            self.env['crm.sales.unit.queue'].invalidate_model()
+            _logger.info("Varredura da fila removeu %s funcionários sem attendance aberto: %s", len(removed), removed)
+        return len(removed)
 
 
     # ======================================================
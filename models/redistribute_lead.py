@@ -24,7 +24,7 @@ class RedistributeLeadWizard(models.TransientModel):
     def action_redistribute(self):
         # 🔎 Agora não bloqueia se o corretor estiver ativo
         leads = self.env['crm.lead'].search([('user_id', '=', self.source_user_id.id)])
-        stage_novo = self.env['crm.stage'].search([('name', '=', 'Novo')], limit=1)
+        stage_novo = self.env['crm.stage']._get_stage_by_name('Novo')
 
         leads = leads.filtered(lambda l: l.stage_id.name not in ["Venda Fechada", "Repasse"])
 
@@ -1,11 +1,43 @@
 # -*- coding: utf-8 -*-
 import logging
-from odoo import models, fields, api, _
+from collections import defaultdict, namedtuple
+
+import psycopg2
+
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError, ValidationError, AccessError
 from odoo import SUPERUSER_ID
+from odoo.osv import expression
 
 _logger = logging.getLogger(__name__)
 
+# Grupos seguros padronizados aplicados a usuários criados/editados por líderes
+SAFE_GROUP_XMLIDS = [
+    'base.group_user',
+    'sales_team.group_sale_salesman',
+    'base.group_partner_manager',
+    'base.group_multi_currency',
+    'mail.group_mail_canned_response_admin',
+    'mail.group_mail_notification_type_inbox',
+    'base.group_no_one',
+]
+
+# Campos de usuário que alteram a hierarquia (e portanto a versão dela)
+HIERARCHY_USER_FIELDS = {"sales_unit_id", "groups_id", "active"}
+
+# Cargos da hierarquia, do mais alto para o mais baixo
+ROLE_GROUP_XMLIDS = [
+    ('president', 'crm_sales_unit.group_president'),
+    ('director', 'crm_sales_unit.group_director'),
+    ('manager', 'crm_sales_unit.group_manager'),
+    ('coordinator', 'crm_sales_unit.group_coordinator'),
+]
+
+# Contexto de autorização de um usuário na hierarquia (imutável, em cache)
+HierarchyAuth = namedtuple(
+    "HierarchyAuth", ["role", "unit_id", "managed_unit_ids", "safe_group_ids", "role_group_ids"]
+)
+
 
 class ResUsers(models.Model):
     _inherit = "res.users"
@@ -19,6 +51,12 @@ class ResUsers(models.Model):
         ondelete="set null"
     )
 
+    responsible_unit_ids = fields.One2many(
+        "crm.sales.unit",
+        "responsible_id",
+        string="Unidades sob Responsabilidade"
+    )
+
     allowed_user_ids = fields.Many2many(
         "res.users",
         "res_users_allowed_rel",
@@ -29,131 +67,323 @@ class ResUsers(models.Model):
         store=True
     )
 
+    def init(self):
+        # Cargos exclusivos garantidos no banco: trigger adiado até o commit, para que
+        # trocas de cargo (remove + adiciona) na mesma transação não sejam bloqueadas
+        role_names = [xmlid.split(".", 1)[1] for _role, xmlid in ROLE_GROUP_XMLIDS]
+        self.env.cr.execute("""
+            CREATE OR REPLACE FUNCTION crm_sales_unit_check_exclusive_role() RETURNS trigger AS $$
+            BEGIN
+                IF (SELECT COUNT(*)
+                      FROM res_groups_users_rel rel
+                      JOIN ir_model_data imd
+                        ON imd.model = 'res.groups' AND imd.res_id = rel.gid
+                     WHERE rel.uid = NEW.uid
+                       AND imd.module = 'crm_sales_unit'
+                       AND imd.name = ANY(%s)) > 1 THEN
+                    RAISE EXCEPTION 'O usuário %% não pode ter múltiplos cargos', NEW.uid
+                        USING ERRCODE = 'check_violation';
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS crm_sales_unit_exclusive_role ON res_groups_users_rel;
+            CREATE CONSTRAINT TRIGGER crm_sales_unit_exclusive_role
+                AFTER INSERT ON res_groups_users_rel
+                DEFERRABLE INITIALLY DEFERRED
+                FOR EACH ROW EXECUTE FUNCTION crm_sales_unit_check_exclusive_role();
+        """, [role_names])
+
     # ======================================================
     # CÁLCULO DE USUÁRIOS VISÍVEIS
     # ======================================================
-    @api.depends(
-        "sales_unit_id",
-        "sales_unit_id.child_ids",
-        "sales_unit_id.member_ids",
-        "sales_unit_id.responsible_id",
-        "groups_id"
-    )
+    # Só os campos do próprio usuário: mudanças na árvore (membros, pais e
+    # responsáveis das unidades) passam por _refresh_allowed_user_ids, que
+    # recalcula apenas os afetados ou agenda o job em segundo plano
     @api.depends("sales_unit_id", "groups_id")
     def _compute_allowed_user_ids(self):
+        allowed_map = self._get_allowed_user_map()
         for user in self:
-            allowed_users = self.env["res.users"]
-            allowed_users |= user  # sempre inclui o próprio
+            # A escrita do m2m é agrupada pelo ORM no flush (um DELETE/INSERT para todos)
+            user.allowed_user_ids = self.env["res.users"].browse(allowed_map[user.id])
+
+    def _get_allowed_user_map(self):
+        """{id do usuário: ids visíveis} para o recordset inteiro, em consultas agregadas.
+
+        Mesmas regras do cálculo por usuário: presidentes veem todos; os demais
+        veem a si mesmos e, se chefiam uma unidade, os membros e responsáveis de
+        todas as unidades abaixo dela (prefixo de parent_path).
+        """
+        Users = self.env["res.users"].sudo()
+        Unit = self.env["crm.sales.unit"].sudo()
+        user_ids = [uid for uid in self.ids if isinstance(uid, int)]
+
+        # 1) Presidentes do recordset, e todos os usuários se houver algum
+        presidents = set()
+        president_group = self.env.ref("crm_sales_unit.group_president", raise_if_not_found=False)
+        if president_group and user_ids:
+            presidents = set(Users.search([
+                ("id", "in", user_ids), ("groups_id", "in", president_group.id)
+            ]).ids)
+        all_user_ids = set(Users.search([]).ids) if presidents else set()
+
+        # 2) Unidade chefiada por cada usuário (mesma ordem do search por usuário)
+        led_units = {}
+        for unit in Unit.search_fetch(
+            [("responsible_id", "in", user_ids)], ["responsible_id", "parent_path"], order="type desc"
+        ):
+            led_units.setdefault(unit.responsible_id.id, unit)
+
+        # 3) Descendentes de todas essas unidades e seus membros, de uma vez
+        paths = {unit.parent_path for unit in led_units.values()}
+        descendants = Unit
+        if paths:
+            descendants = Unit.search_fetch(
+                expression.OR([[("parent_path", "=like", path + "%")] for path in paths]),
+                ["parent_path", "responsible_id"],
+            )
+        members_by_unit = defaultdict(set)
+        for member in Users.search_fetch([("sales_unit_id", "in", descendants.ids)], ["sales_unit_id"]):
+            members_by_unit[member.sales_unit_id.id].add(member.id)
+
+        visible_by_path = {}
+        for path in paths:
+            visible = set()
+            for unit in descendants:
+                if unit.parent_path.startswith(path):
+                    visible |= members_by_unit[unit.id]
+                    if unit.responsible_id:
+                        visible.add(unit.responsible_id.id)
+            visible_by_path[path] = visible
+
+        allowed_map = {}
+        for user in self:
+            if user.id in presidents:
+                allowed_map[user.id] = all_user_ids
+                continue
+            allowed = {user.id}
+            unit = led_units.get(user.id)
+            if unit:
+                allowed |= visible_by_path[unit.parent_path]
+            allowed_map[user.id] = allowed
+        return allowed_map
+
+    # ======================================================
+    # DOMÍNIO DE VISIBILIDADE PARA REGRAS DE REGISTRO
+    # ======================================================
+    def _sales_visibility_domain(self, field_name="user_id"):
+        """Domínio de visibilidade pela hierarquia, usado nas ir.rule.
+
+        A árvore é resolvida no banco (child_of vira prefixo de parent_path ao
+        montar a consulta), sem listas literais de ids: o próprio usuário, os
+        membros e os responsáveis das unidades abaixo da unidade que ele chefia.
+        O domínio em cache depende só da unidade chefiada, não da árvore.
+        """
+        self.ensure_one()
+        user = self.sudo()
+        if user.has_group("crm_sales_unit.group_president"):
+            return [(1, "=", 1)]
+
+        domain = [(field_name, "=", user.id)]
+        unit = self.env["crm.sales.unit"].sudo().search([
+            ("responsible_id", "=", user.id)
+        ], limit=1, order="type desc")
+        if unit:
+            domain = expression.OR([
+                domain,
+                [(f"{field_name}.sales_unit_id", "child_of", unit.id)],
+                [(f"{field_name}.responsible_unit_ids", "child_of", unit.id)],
+            ])
+        return domain
 
-            if user.has_group("crm_sales_unit.group_president"):
-                allowed_users = self.env["res.users"].search([])
-            else:
-                responsible_for_unit = self.env["crm.sales.unit"].search([
-                    ("responsible_id", "=", user.id)
-                ], limit=1, order="type desc")
+    # ======================================================
+    # RECOMPUTE INCREMENTAL DA VISIBILIDADE
+    # ======================================================
+    @api.model
+    def _get_hierarchy_affected_users(self, units):
+        """Usuários cuja visibilidade depende das unidades informadas.
+
+        Usa o parent_path das unidades para chegar aos ancestrais em uma única
+        leitura: só os responsáveis dessa cadeia (e os presidentes, que veem
+        todos) precisam de recompute quando membros entram ou saem.
+        """
+        ancestor_ids = set()
+        for path in units.sudo().mapped("parent_path"):
+            ancestor_ids.update(int(unit_id) for unit_id in path.split("/") if unit_id)
+
+        affected = self.env["crm.sales.unit"].sudo().browse(ancestor_ids).mapped("responsible_id")
+        president_group = self.env.ref("crm_sales_unit.group_president", raise_if_not_found=False)
+        if president_group:
+            affected |= president_group.sudo().users
+        return affected
+
+    def _refresh_allowed_user_ids(self, units=None):
+        """Recalcula a visibilidade de self e dos usuários afetados pelas unidades.
+
+        Acima do limite configurado, o recálculo vai para um job em segundo plano
+        e os leitores continuam vendo o estado anterior até a troca final.
+        """
+        affected = self
+        if units:
+            affected |= self._get_hierarchy_affected_users(units)
+        Job = self.env["crm.sales.unit.visibility.job"]
+        if len(affected) > Job._get_sync_threshold():
+            Job._enqueue(affected)
+            return affected
+        affected.sudo().with_context(skip_hierarchy_check=True)._compute_allowed_user_ids()
+        return affected
 
-                if responsible_for_unit:
-                    descendant_units = self.env["crm.sales.unit"].search([
-                        ("id", "child_of", responsible_for_unit.id)
-                    ])
-                    allowed_users |= descendant_units.mapped("member_ids")
-                    allowed_users |= descendant_units.mapped("responsible_id")
 
-            user.allowed_user_ids = allowed_users
+    # ======================================================
+    # CONTEXTO DE AUTORIZAÇÃO NA HIERARQUIA (EM CACHE)
+    # ======================================================
+    @api.model
+    @tools.ormcache()
+    def _get_hierarchy_group_ids(self):
+        """(ids dos grupos seguros, {cargo: id do grupo}) resolvidos uma única vez"""
+        safe_group_ids = tuple(self.env.ref(xmlid).id for xmlid in SAFE_GROUP_XMLIDS)
+        role_group_ids = {}
+        for role, xmlid in ROLE_GROUP_XMLIDS:
+            group = self.env.ref(xmlid, raise_if_not_found=False)
+            if group:
+                role_group_ids[role] = group.id
+        return safe_group_ids, tools.frozendict(role_group_ids)
+
+    @api.model
+    def _get_hierarchy_auth(self, uid):
+        """Cargo, unidade e unidades sob gestão do usuário, em cache por versão da hierarquia"""
+        version = self.env["crm.sales.unit.hierarchy.log"]._get_hierarchy_cache_key()
+        return self._get_hierarchy_auth_for_version(uid, version)
+
+    @api.model
+    @tools.ormcache('uid', 'version')
+    def _get_hierarchy_auth_for_version(self, uid, version):
+        """Calculado uma vez por usuário e versão: qualquer mudança de grupos, de
+        unidade do usuário ou da árvore de unidades gera uma nova versão.
+        """
+        safe_group_ids, role_group_ids = self._get_hierarchy_group_ids()
+        user = self.sudo().browse(uid)
+        user_group_ids = set(user.groups_id.ids)
+        role = next(
+            (role for role, _xmlid in ROLE_GROUP_XMLIDS if role_group_ids.get(role) in user_group_ids),
+            False,
+        )
 
+        Unit = self.env["crm.sales.unit"].sudo()
+        unit = user.sales_unit_id
+        if role == "president":
+            managed_units = Unit.search([])
+        elif role == "director" and unit:
+            managed_units = Unit.search([("id", "child_of", unit.id)])
+        elif role == "manager":
+            managed_units = unit.child_ids | unit
+        elif role == "coordinator":
+            managed_units = unit
+        else:
+            managed_units = Unit
+
+        return HierarchyAuth(
+            role=role,
+            unit_id=unit.id,
+            managed_unit_ids=frozenset(managed_units.ids),
+            safe_group_ids=safe_group_ids,
+            role_group_ids=frozenset(role_group_ids.values()),
+        )
 
     # ======================================================
     # CRIAÇÃO DE USUÁRIO COM PADRONIZAÇÃO E TOKEN
     # ======================================================
     @api.model_create_multi
     def create(self, vals_list):
-        users = self.env["res.users"]
+        # ✅ Superusuário sempre pode (dados do módulo, scripts e testes), com o mesmo
+        # controle de cargos, log de hierarquia e recálculo de visibilidade
+        if self.env.uid == SUPERUSER_ID:
+            users = super().create(vals_list)
+            users._check_unique_sales_unit_role()
+            self.env["crm.sales.unit.hierarchy.log"]._log_change(
+                "user_create", units=users.mapped("sales_unit_id"), users=users
+            )
+            users._refresh_allowed_user_ids(users.mapped("sales_unit_id"))
+            return users
+
         creator = self.env.user
-        creator_unit = creator.sales_unit_id
-
-        # Grupos seguros padronizados
-        safe_group_ids = [
-            self.env.ref('base.group_user').id,
-            self.env.ref('sales_team.group_sale_salesman').id,
-            self.env.ref('base.group_partner_manager').id,
-            self.env.ref('base.group_multi_currency').id,
-            self.env.ref('mail.group_mail_canned_response_admin').id,
-            self.env.ref('mail.group_mail_notification_type_inbox').id,
-            self.env.ref('base.group_no_one').id,
-        ]
+        auth = self._get_hierarchy_auth(self.env.uid)
+        company = self.env.company
 
-        for vals in vals_list:
-            target_unit_id = vals.get("sales_unit_id")
+        # 🔐 Apenas líderes podem criar
+        if not auth.role:
+            raise UserError(_("Você não tem permissão para criar usuários."))
 
-            # 🔐 Apenas líderes podem criar
-            if not (
-                creator.has_group("crm_sales_unit.group_coordinator")
-                or creator.has_group("crm_sales_unit.group_manager")
-                or creator.has_group("crm_sales_unit.group_director")
-                or creator.has_group("crm_sales_unit.group_president")
-            ):
-                raise UserError(_("Você não tem permissão para criar usuários."))
+        if not auth.unit_id and auth.role != "president":
+            raise UserError(_("Você precisa estar vinculado a uma Unidade de Vendas para criar usuários."))
 
-            if not creator_unit and not creator.has_group("crm_sales_unit.group_president"):
-                raise UserError(_("Você precisa estar vinculado a uma Unidade de Vendas para criar usuários."))
+        # Passada única de validação e padronização sobre o lote
+        for vals in vals_list:
+            target_unit_id = vals.get("sales_unit_id")
 
             # 📊 Hierarquia de criação
-            if creator.has_group("crm_sales_unit.group_coordinator"):
-                vals["sales_unit_id"] = creator_unit.id
-
-            elif creator.has_group("crm_sales_unit.group_manager"):
-                target_unit = self.env["crm.sales.unit"].browse(target_unit_id) if target_unit_id else creator_unit
-                allowed_units = creator_unit.child_ids.ids + [creator_unit.id]
-                if target_unit.id not in allowed_units:
+            if auth.role == "coordinator":
+                if target_unit_id and target_unit_id != auth.unit_id:
+                    raise UserError(_("Coordenador só pode criar usuários na sua própria coordenação."))
+                vals["sales_unit_id"] = auth.unit_id
+
+            elif auth.role == "manager":
+                target_id = target_unit_id or auth.unit_id
+                if target_id not in auth.managed_unit_ids:
                     raise UserError(_("Gerente só pode criar usuários na sua gerência ou coordenações abaixo dela."))
-                vals["sales_unit_id"] = target_unit.id
+                vals["sales_unit_id"] = target_id
 
-            elif creator.has_group("crm_sales_unit.group_director"):
-                target_unit = self.env["crm.sales.unit"].browse(target_unit_id) if target_unit_id else creator_unit
-                allowed_units = creator_unit.search([("id", "child_of", creator_unit.id)]).ids
-                if target_unit.id not in allowed_units:
+            elif auth.role == "director":
+                target_id = target_unit_id or auth.unit_id
+                if target_id not in auth.managed_unit_ids:
                     raise UserError(_("Diretor só pode criar usuários em sua diretoria ou subunidades abaixo dela."))
-                vals["sales_unit_id"] = target_unit.id
+                vals["sales_unit_id"] = target_id
 
-            elif creator.has_group("crm_sales_unit.group_president"):
-                if not target_unit_id and creator_unit:
-                    vals["sales_unit_id"] = creator_unit.id
+            elif auth.role == "president":
+                if not target_unit_id and auth.unit_id:
+                    vals["sales_unit_id"] = auth.unit_id
 
             # ✅ Padroniza permissões seguras
-            vals["groups_id"] = [(6, 0, safe_group_ids)]
+            vals["groups_id"] = [(6, 0, list(auth.safe_group_ids))]
             vals["share"] = False
             vals["active"] = True
-            vals["company_id"] = self.env.company.id
-            vals["company_ids"] = [(6, 0, [self.env.company.id])]
-
-            # Cria usuário com sudo (ignora hierarquia do Administrator)
-            user = super(ResUsers, self.sudo()).create([vals])
-            user._check_unique_sales_unit_role()
+            vals["company_id"] = company.id
+            vals["company_ids"] = [(6, 0, [company.id])]
 
-            # 🔗 Vincula na unidade
-            if user.sales_unit_id and user not in user.sales_unit_id.member_ids:
-                user.sales_unit_id.write({'member_ids': [(4, user.id)]})
+        # Cria o lote inteiro com sudo (ignora hierarquia do Administrator)
+        users = super(ResUsers, self.sudo()).create(vals_list)
+        users._check_unique_sales_unit_role()
 
-            users |= user
+        # 🔑 Prepara os convites com superusuário, em lote
+        self._create_signup_tokens(users)
 
-            # 🔑 Gera token de convite com superusuário
-            try:
-                user_with_super = self.env['res.users'].sudo().browse(user.id)
-                user_with_super._signup_create_token()
-                _logger.info("Token de convite gerado com superusuário para [%s]", user.login)
-            except Exception as e:
-                _logger.warning("Falha ao gerar token de convite para [%s]: %s", user.login, e)
+        _logger.info(
+            "Usuário [%s] criou %s usuários com grupos padronizados: %s",
+            creator.login, len(users), ", ".join(users.mapped("login"))
+        )
 
-            _logger.info(
-                "Usuário [%s] criou [%s] com grupos padronizados e unidade [%s]",
-                creator.login, user.login, user.sales_unit_id.display_name
-            )
+        self.env["crm.sales.unit.hierarchy.log"]._log_change(
+            "user_create", units=users.mapped("sales_unit_id"), users=users
+        )
 
-        # ✅ Recompute seguro (ignora hierarquia, inclusive Administrator id=2)
-        self.env['res.users'].sudo().search([])._compute_allowed_user_ids()
+        # ✅ Recompute incremental: novos usuários + responsáveis acima deles + presidentes
+        users._refresh_allowed_user_ids(users.mapped("sales_unit_id"))
 
         return users
 
+    @api.model
+    def _create_signup_tokens(self, users):
+        """Prepara os convites do lote em uma única escrita (só com auth_signup instalado)"""
+        partners = users.sudo().partner_id
+        if not hasattr(partners, "signup_prepare"):
+            return
+        try:
+            with self.env.cr.savepoint():
+                partners.signup_prepare()
+            _logger.info("Convites preparados com superusuário para %s usuários", len(users))
+        except Exception as e:
+            _logger.warning("Falha ao preparar convites para %s usuários: %s", len(users), e)
 
     # ======================================================
     # UPDATE DE USUÁRIO COM HIERARQUIA E SEGURANÇA
@@ -167,7 +397,10 @@ class ResUsers(models.Model):
 
         # ✅ Superusuário sempre pode
         if self.env.user.id == SUPERUSER_ID:
-            return super().write(vals)
+            previous_units = self.mapped("sales_unit_id")
+            res = super().write(vals)
+            self._log_hierarchy_change(vals, previous_units)
+            return res
 
         # ✅ Permite redefinição de senha via convite (sem autenticação)
         invite_fields = {'password', 'signup_token', 'signup_type', 'signup_expiration'}
@@ -179,32 +412,18 @@ class ResUsers(models.Model):
             return super().write(vals)
 
         mover = self.env.user
-        mover_unit = mover.sales_unit_id
+        auth = self._get_hierarchy_auth(self.env.uid)
 
         # 🔒 Verifica se é um líder autorizado
-        if not (
-            mover.has_group("crm_sales_unit.group_president")
-            or mover.has_group("crm_sales_unit.group_director")
-            or mover.has_group("crm_sales_unit.group_manager")
-            or mover.has_group("crm_sales_unit.group_coordinator")
-        ):
+        if not auth.role:
             raise AccessError(_("Você não tem permissão para editar usuários."))
 
-        # 🧭 Determina as unidades sob gestão
-        if mover.has_group("crm_sales_unit.group_president"):
-            allowed_units = self.env["crm.sales.unit"].search([])
-        elif mover.has_group("crm_sales_unit.group_director"):
-            allowed_units = self.env["crm.sales.unit"].search([("id", "child_of", mover_unit.id)])
-        elif mover.has_group("crm_sales_unit.group_manager"):
-            allowed_units = mover_unit.child_ids | mover_unit
-        elif mover.has_group("crm_sales_unit.group_coordinator"):
-            allowed_units = mover_unit
-        else:
-            allowed_units = self.env["crm.sales.unit"]
+        # 🧭 Unidades sob gestão (contexto de autorização em cache)
+        allowed_unit_ids = auth.managed_unit_ids
 
         # 🔍 Filtra recordset: ignora Administrator e usuários fora da hierarquia
         users_to_check = self.filtered(
-            lambda u: u.id != SUPERUSER_ID and u.sales_unit_id and u.sales_unit_id in allowed_units
+            lambda u: u.id != SUPERUSER_ID and u.sales_unit_id.id in allowed_unit_ids
         )
 
         # Se a operação não é apenas persistência de campo computado, bloquear fora da hierarquia
@@ -215,94 +434,109 @@ class ResUsers(models.Model):
             ) % ", ".join(invalid_users.mapped("name")))
 
         # 🔐 Força grupos seguros (em qualquer update do campo groups_id)
-        safe_group_ids = [
-            self.env.ref('base.group_user').id,
-            self.env.ref('sales_team.group_sale_salesman').id,
-            self.env.ref('base.group_partner_manager').id,
-            self.env.ref('base.group_multi_currency').id,
-            self.env.ref('mail.group_mail_canned_response_admin').id,
-            self.env.ref('mail.group_mail_notification_type_inbox').id,
-            self.env.ref('base.group_no_one').id,
-        ]
         if "groups_id" in vals:
-            vals["groups_id"] = [(6, 0, safe_group_ids)]
+            vals["groups_id"] = [(6, 0, list(auth.safe_group_ids))]
 
         # 🧩 Valida movimentação de unidade
         target_unit_id = vals.get("sales_unit_id")
         if target_unit_id:
             target_unit = self.env["crm.sales.unit"].browse(target_unit_id)
-            if target_unit not in allowed_units:
+            if target_unit.id not in allowed_unit_ids:
                 raise AccessError(_(
                     "Você não pode mover usuários para a unidade '%s', pois ela está fora da sua hierarquia."
                 ) % target_unit.display_name)
 
+        # Unidades de origem, para recalcular quem deixa de ver os usuários movidos
+        previous_units = users_to_check.mapped("sales_unit_id")
+
         # 💾 Aplica alterações seguras apenas nos usuários válidos
         res = super(ResUsers, users_to_check).write(vals)
 
         # 🔄 Atualiza vínculo com unidade
         if "sales_unit_id" in vals:
-            for user in users_to_check:
-                old_units = self.env["crm.sales.unit"].search([("member_ids", "in", user.id)])
-                for unit in old_units:
-                    if unit != user.sales_unit_id:
-                        unit.write({'member_ids': [(3, user.id)]})
-                if user.sales_unit_id and user not in user.sales_unit_id.member_ids:
-                    user.sales_unit_id.write({'member_ids': [(4, user.id)]})
-                _logger.info(
-                    "Usuário [%s] movido para Unidade [%s]",
-                    user.login,
-                    user.sales_unit_id.display_name if user.sales_unit_id else "Nenhuma"
-                )
+            # member_ids é o inverso de sales_unit_id: o UPDATE acima já moveu todos
+            target_unit = self.env["crm.sales.unit"].browse(vals["sales_unit_id"])
+            _logger.info(
+                "Usuários [%s] movidos para Unidade [%s]",
+                ", ".join(users_to_check.mapped("login")),
+                target_unit.display_name if target_unit else "Nenhuma"
+            )
 
         # 🔎 Verifica cargos exclusivos
         users_to_check._check_unique_sales_unit_role()
 
-        # ✅ Recompute da visibilidade para todos os envolvidos na hierarquia do mover
-        affected_users = users_to_check | mover
+        # 🧾 Nova versão da hierarquia + log da alteração
+        users_to_check._log_hierarchy_change(vals, previous_units)
 
-        # Inclui todos os gestores e membros sob as unidades que o gestor controla
-        affected_units = allowed_units
-        affected_users |= affected_units.mapped("responsible_id")
-        affected_users |= affected_units.mapped("member_ids")
+        # ✅ Recompute incremental: usuários alterados + responsáveis acima das unidades
+        # de origem e destino (via parent_path) + presidentes
+        if HIERARCHY_USER_FIELDS & set(vals):
+            affected_units = previous_units
+            if "sales_unit_id" in vals:
+                affected_units |= users_to_check.mapped("sales_unit_id")
+            affected_users = users_to_check._refresh_allowed_user_ids(affected_units)
 
-        # 🔄 Se houve movimentação de unidade, também recalcular gestores acima do novo destino
-        if "sales_unit_id" in vals:
-            target_unit = self.env["crm.sales.unit"].browse(vals["sales_unit_id"])
-            while target_unit:
-                if target_unit.responsible_id:
-                    affected_users |= target_unit.responsible_id
-                target_unit = target_unit.parent_id
-                # Para não subir além do gestor que moveu
-                if target_unit and target_unit.responsible_id == mover:
-                    break
-
-        # Força recompute com bypass de hierarquia
-        affected_users.with_context(skip_hierarchy_check=True)._compute_allowed_user_ids()
-
-        _logger.info(
-            "Campo allowed_user_ids recalculado para %s usuários (afetados + gestores envolvidos na movimentação feita por %s).",
-            len(affected_users), mover.name
-)
+            _logger.info(
+                "Campo allowed_user_ids recalculado para %s usuários (alteração feita por %s).",
+                len(affected_users), mover.name
+            )
         return res
 
+    def _log_hierarchy_change(self, vals, previous_units):
+        """Registra no log de hierarquia as alterações de unidade, grupos ou arquivamento"""
+        changed_fields = HIERARCHY_USER_FIELDS & set(vals)
+        if not self or not changed_fields:
+            return
+        change_type = "user_archive" if vals.get("active") is False else "user_write"
+        self.env["crm.sales.unit.hierarchy.log"]._log_change(
+            change_type,
+            units=previous_units | self.mapped("sales_unit_id"),
+            users=self,
+            changed_fields=changed_fields,
+        )
+
     # ======================================================
     # VERIFICAÇÃO DE CARGOS EXCLUSIVOS
     # ======================================================
     def _check_unique_sales_unit_role(self):
-        """Impede múltiplos cargos"""
-        role_groups = [
-            self.env.ref("crm_sales_unit.group_coordinator", raise_if_not_found=False),
-            self.env.ref("crm_sales_unit.group_manager", raise_if_not_found=False),
-            self.env.ref("crm_sales_unit.group_director", raise_if_not_found=False),
-            self.env.ref("crm_sales_unit.group_president", raise_if_not_found=False),
-        ]
-        role_group_ids = [g.id for g in role_groups if g]
-
-        for user in self:
-            cargos = user.groups_id.filtered(lambda g: g.id in role_group_ids)
-            if len(cargos) > 1:
-                raise ValidationError(
-                    f"O usuário {user.name} não pode ter múltiplos cargos "
-                    f"(atualmente: {', '.join(cargos.mapped('name'))}). "
-                    f"Selecione apenas um."
-                )
+        """Impede múltiplos cargos (uma consulta para todo o lote)"""
+        role_group_ids = self._get_hierarchy_group_ids()[1].values()
+        if not self or not role_group_ids:
+            return
+
+        self.flush_recordset(["groups_id"])
+        self.env.cr.execute("""
+            SELECT uid, array_agg(gid)
+              FROM res_groups_users_rel
+             WHERE uid = ANY(%s) AND gid = ANY(%s)
+          GROUP BY uid
+            HAVING COUNT(*) > 1
+             LIMIT 1
+        """, [self.ids, list(role_group_ids)])
+        for user_id, group_ids in self.env.cr.fetchall():
+            user = self.browse(user_id)
+            cargos = self.env["res.groups"].browse(group_ids)
+            raise ValidationError(
+                f"O usuário {user.name} não pode ter múltiplos cargos "
+                f"(atualmente: {', '.join(cargos.mapped('name'))}). "
+                f"Selecione apenas um."
+            )
+        self._check_exclusive_role_trigger()
+
+    def _check_exclusive_role_trigger(self):
+        """Antecipa a verificação adiada do trigger de cargo exclusivo.
+
+        O trigger só dispararia no COMMIT, com um erro cru do banco; aqui as
+        pendências são verificadas já (cobrindo escritas feitas por res.groups)
+        e o modo volta a ser adiado para as próximas trocas de cargo.
+        """
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute("""
+                    SET CONSTRAINTS crm_sales_unit_exclusive_role IMMEDIATE;
+                    SET CONSTRAINTS crm_sales_unit_exclusive_role DEFERRED;
+                """)
+        except psycopg2.errors.CheckViolation:
+            raise ValidationError(_(
+                "Um usuário não pode ter múltiplos cargos na hierarquia de vendas. Selecione apenas um."
+            ))
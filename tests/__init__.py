@@ -1 +1,4 @@
 from . import test_res_users
+from . import test_stage_history
+from . import test_queue
+from . import test_visibility
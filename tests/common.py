@@ -0,0 +1,69 @@
+from odoo.tests.common import TransactionCase
+
+
+class SalesHierarchyCase(TransactionCase):
+    """Hierarquia completa (presidência → diretoria → gerência → coordenação),
+    cada unidade com o seu próprio responsável."""
+
+    def setUp(self):
+        super().setUp()
+        self.Users = self.env['res.users']
+        self.SalesUnit = self.env['crm.sales.unit']
+        self.admin = self.env.ref("base.user_admin")
+
+        # Responsáveis primeiro: a unidade exige responsável
+        self.socio = self._make_user("Sócio", "socio", "crm_sales_unit.group_president", None)
+        self.diretor = self._make_user("Diretor", "diretor", "crm_sales_unit.group_director", None)
+        self.gerente = self._make_user("Gerente", "gerente", "crm_sales_unit.group_manager", None)
+        self.coordenador = self._make_user("Coordenador", "coordenador", "crm_sales_unit.group_coordinator", None)
+
+        # Criar hierarquia de unidades
+        self.presidencia = self.SalesUnit.create({
+            'name': 'Presidência A',
+            'type': 'presidencia',
+            'responsible_id': self.socio.id,
+        })
+        self.directoria = self.SalesUnit.create({
+            'name': 'Diretoria A',
+            'type': 'diretoria',
+            'parent_id': self.presidencia.id,
+            'responsible_id': self.diretor.id,
+        })
+        self.gerencia = self.SalesUnit.create({
+            'name': 'Gerência A',
+            'type': 'gerencia',
+            'parent_id': self.directoria.id,
+            'responsible_id': self.gerente.id,
+        })
+        self.coordenacao = self.SalesUnit.create({
+            'name': 'Coordenação A',
+            'type': 'coordenacao',
+            'parent_id': self.gerencia.id,
+            'responsible_id': self.coordenador.id,
+        })
+
+        # Cada líder é membro da unidade que chefia
+        self.socio.write({'sales_unit_id': self.presidencia.id})
+        self.diretor.write({'sales_unit_id': self.directoria.id})
+        self.gerente.write({'sales_unit_id': self.gerencia.id})
+        self.coordenador.write({'sales_unit_id': self.coordenacao.id})
+
+    def _make_user(self, name, login, group_xmlid, sales_unit_id):
+        """Cria usuários de teste vinculados a unidades e grupos (como superusuário)"""
+        return self.Users.create({
+            'name': name,
+            'login': login,
+            'sales_unit_id': sales_unit_id,
+            'groups_id': [(6, 0, [self.env.ref(group_xmlid).id])],
+        })
+
+    def _make_unit(self, name, unit_type, parent=None):
+        """Cria uma unidade com um responsável próprio (abaixo da presidência por padrão)"""
+        login = name.lower().replace(' ', '_')
+        responsible = self._make_user(f"Responsável {name}", f"resp_{login}", "base.group_user", None)
+        return self.SalesUnit.create({
+            'name': name,
+            'type': unit_type,
+            'parent_id': (parent or self.presidencia).id,
+            'responsible_id': responsible.id,
+        })
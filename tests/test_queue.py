@@ -0,0 +1,191 @@
+import ipaddress
+from datetime import datetime, timedelta
+
+import pytz
+
+from odoo import fields
+
+from odoo.addons.crm_sales_unit.tests.common import SalesHierarchyCase
+
+
+class TestQueue(SalesHierarchyCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Queue = self.env['crm.sales.unit.queue']
+        self.Attendance = self.env['hr.attendance']
+        self.Employee = self.env['hr.employee']
+        self.env['crm.sales.unit.config'].get_config().write({'start_time': 13.0, 'end_time': 21.0})
+
+        user = self.Users.with_user(self.coordenador).create({'name': 'Corretor Fila', 'login': 'corretor_fila'})
+        self.employee = self.Employee.create({'name': 'Corretor Fila', 'user_id': user.id})
+
+    def _utc(self, hour):
+        """Hora local de hoje (America/Sao_Paulo) convertida para UTC naive"""
+        tz = pytz.timezone('America/Sao_Paulo')
+        local = datetime.now(tz).replace(hour=hour, minute=0, second=0, microsecond=0)
+        return local.astimezone(pytz.UTC).replace(tzinfo=None)
+
+    def test_popular_fila_e_idempotente(self):
+        self.Attendance.create({'employee_id': self.employee.id, 'check_in': self._utc(10)})
+
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 1)
+        queue = self.Queue.search([('employee_id', '=', self.employee.id)])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.date, fields.Date.context_today(self.Employee))
+
+        # Segunda execução não duplica
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 0)
+        self.assertEqual(self.Queue.search_count([('employee_id', '=', self.employee.id)]), 1)
+
+    def test_reentrada_reativa_entrada_removida(self):
+        queue = self.Queue.create({
+            'user_id': self.employee.user_id.id,
+            'employee_id': self.employee.id,
+            'checkin_time': fields.Datetime.now(),
+            'date': fields.Date.today(),
+        })
+        queue.remove_from_queue()
+        self.assertFalse(queue.active)
+
+        # Sem duplicar a entrada do dia (única por funcionário/data)
+        self.employee.with_user(self.socio).sudo().add_to_queue()
+        self.assertTrue(queue.active)
+        self.assertEqual(self.Queue.with_context(active_test=False).search_count([
+            ('employee_id', '=', self.employee.id),
+        ]), 1)
+
+    def test_popular_fila_reativa_quem_saiu(self):
+        self.Attendance.create({'employee_id': self.employee.id, 'check_in': self._utc(10)})
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 1)
+        queue = self.Queue.search([('employee_id', '=', self.employee.id)])
+        queue.remove_from_queue()
+
+        # Ainda com check-in aberto: volta para a fila na mesma entrada do dia
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 1)
+        self.assertTrue(queue.active)
+        self.assertEqual(self.Queue.with_context(active_test=False).search_count([
+            ('employee_id', '=', self.employee.id),
+        ]), 1)
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 0)
+
+    def test_popular_fila_ignora_fora_da_janela(self):
+        self.Attendance.create({'employee_id': self.employee.id, 'check_in': self._utc(8)})
+        self.assertEqual(self.Employee.populate_queue_start_of_day(), 0)
+
+    def test_checkout_fim_do_dia_em_lote(self):
+        ontem = fields.Datetime.now() - timedelta(days=1)
+        self.Attendance.create({'employee_id': self.employee.id, 'check_in': ontem})
+        self.Queue.create({
+            'user_id': self.employee.user_id.id,
+            'employee_id': self.employee.id,
+            'checkin_time': ontem,
+        })
+
+        summary = self.Employee.force_end_of_day_checkout()
+        self.assertEqual(summary['previous_day'], 1)
+        self.assertEqual(summary['queue_removed'], 1)
+        self.assertFalse(self.Attendance.search([('employee_id', '=', self.employee.id), ('check_out', '=', False)]))
+        self.assertFalse(self.Queue.search([('employee_id', '=', self.employee.id)]))
+
+    def test_checkout_do_gestor_remove_da_fila(self):
+        # Attendance esquecido aberto desde ontem e entrada de hoje na fila
+        ontem = fields.Datetime.now() - timedelta(days=1)
+        attendance = self.Attendance.create({'employee_id': self.employee.id, 'check_in': ontem})
+        self.Queue.create({
+            'user_id': self.employee.user_id.id,
+            'employee_id': self.employee.id,
+            'checkin_time': ontem,
+            'date': fields.Date.context_today(self.Employee),
+        })
+
+        self.employee.with_user(self.socio).sudo().manager_force_checkout()
+        self.assertTrue(attendance.check_out)
+        self.assertFalse(self.Queue.search([('employee_id', '=', self.employee.id)]))
+
+    def test_checkout_remove_da_fila_na_mesma_transacao(self):
+        attendance = self.Attendance.create({'employee_id': self.employee.id, 'check_in': fields.Datetime.now()})
+        self.Queue.create({
+            'user_id': self.employee.user_id.id,
+            'employee_id': self.employee.id,
+            'checkin_time': attendance.check_in,
+        })
+
+        attendance.write({'check_out': fields.Datetime.now()})
+        self.assertFalse(self.Queue.search([('employee_id', '=', self.employee.id)]))
+
+    def test_distribuicao_em_rodizio(self):
+        outro_user = self.Users.with_user(self.coordenador).create({'name': 'Corretor Fila 2', 'login': 'corretor_fila_2'})
+        fila = self.Queue.create([
+            {'user_id': self.employee.user_id.id, 'employee_id': self.employee.id,
+             'checkin_time': fields.Datetime.now() - timedelta(minutes=5)},
+            {'user_id': outro_user.id, 'checkin_time': fields.Datetime.now()},
+        ])
+        self.env['crm.sales.unit.config'].get_config().lead_dispatch_enabled = True
+        stage = self.env['crm.stage'].create({'name': 'Etapa Fila', 'funnel_sequence': 2001})
+        leads = self.env['crm.lead'].create([
+            {'name': f'Lead {i}', 'user_id': False, 'stage_id': stage.id} for i in range(3)
+        ])
+        # Sem corretor não há histórico: o precommit não pode violar o NOT NULL de user_id
+        self.env.cr.precommit.run()
+        History = self.env['crm.lead.stage.history']
+        self.assertFalse(History.search([('lead_id', 'in', leads.ids)]))
+
+        result = self.Queue._dispatch_leads()
+        self.assertEqual(sorted(len(ids) for ids in result.values()), [1, 2])
+        self.assertFalse(leads.filtered(lambda lead: not lead.user_id))
+        self.assertEqual(sum(fila.mapped('assigned_count')), 3)
+        self.assertTrue(all(fila.mapped('last_assigned_at')))
+
+        # A primeira atribuição registra a etapa atual para o novo corretor
+        self.env.cr.precommit.run()
+        historico = History.search([('lead_id', 'in', leads.ids)])
+        self.assertEqual(len(historico), 3)
+        self.assertEqual(historico.stage_id, stage)
+        self.assertEqual(historico.mapped('user_id'), leads.mapped('user_id'))
+
+        # Sem leads livres, nada a distribuir
+        self.assertEqual(self.Queue._dispatch_leads(), {})
+
+    def test_distribuicao_ignora_leads_anteriores(self):
+        self.Queue.create({
+            'user_id': self.employee.user_id.id,
+            'employee_id': self.employee.id,
+            'checkin_time': fields.Datetime.now(),
+        })
+        config = self.env['crm.sales.unit.config'].get_config()
+        cron = self.env.ref('crm_sales_unit.cron_dispatch_leads')
+        config.lead_dispatch_enabled = False
+        self.assertFalse(cron.active)
+
+        # Leads sem corretor criados antes da habilitação (ou importados) ficam onde estão
+        antigo = self.env['crm.lead'].create({'name': 'Lead Antigo', 'user_id': False})
+        self.assertFalse(antigo.queue_dispatch)
+        self.assertEqual(self.Queue._cron_dispatch_leads(), 0)
+
+        config.lead_dispatch_enabled = True
+        self.assertTrue(cron.active)
+        novo = self.env['crm.lead'].create({'name': 'Lead Novo', 'user_id': False})
+        self.assertTrue(novo.queue_dispatch)
+
+        result = self.Queue._dispatch_leads()
+        self.assertEqual(result, {self.employee.user_id.id: [novo.id]})
+        self.assertFalse(antigo.user_id)
+        self.assertEqual(novo.user_id, self.employee.user_id)
+        self.assertFalse(novo.queue_dispatch)
+
+    def test_matcher_de_ip(self):
+        IPRange = self.env['crm.sales.unit.ip']
+        IPRange.search([]).unlink()
+        externo = IPRange.create({'cidr': '10.0.0.0/8'})
+        IPRange.create({'cidr': '10.1.0.0/16'})
+        unico = IPRange.create({'cidr': '192.168.1.5'})
+
+        self.assertEqual(IPRange._match_ip(ipaddress.ip_address('10.1.2.3')), externo)
+        self.assertEqual(IPRange._match_ip(ipaddress.ip_address('192.168.1.5')), unico)
+        self.assertFalse(IPRange._match_ip(ipaddress.ip_address('192.168.1.6')))
+        self.assertFalse(IPRange._match_ip(ipaddress.ip_address('::1')))
+
+        # Alterações nos ranges invalidam o matcher em cache
+        unico.write({'cidr': '192.168.1.0/24'})
+        self.assertEqual(IPRange._match_ip(ipaddress.ip_address('192.168.1.6')), unico)
@@ -1,48 +1,11 @@
-from odoo.tests.common import TransactionCase
-from odoo.exceptions import UserError, AccessError, ValidationError
+import psycopg2
 
+from odoo.addons.crm_sales_unit.tests.common import SalesHierarchyCase
+from odoo.exceptions import UserError, AccessError, ValidationError
+from odoo.tools import mute_logger
 
-class TestResUsers(TransactionCase):
 
-    def setUp(self):
-        super().setUp()
-        self.Users = self.env['res.users']
-        self.SalesUnit = self.env['crm.sales.unit']
-        self.admin = self.env.ref("base.user_admin")
-
-        # Criar hierarquia de unidades
-        self.directoria = self.SalesUnit.create({
-            'name': 'Diretoria A',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
-        self.gerencia = self.SalesUnit.create({
-            'name': 'Gerência A',
-            'type': 'gerencia',
-            'parent_id': self.directoria.id,
-            'responsible_id': self.admin.id,
-        })
-        self.coordenacao = self.SalesUnit.create({
-            'name': 'Coordenação A',
-            'type': 'coordenacao',
-            'parent_id': self.gerencia.id,
-            'responsible_id': self.admin.id,
-        })
-
-        # Criar perfis de teste
-        self.socio = self._make_user("Sócio", "socio", "crm_sales_unit.group_president", None)
-        self.diretor = self._make_user("Diretor", "diretor", "crm_sales_unit.group_director", self.directoria.id)
-        self.gerente = self._make_user("Gerente", "gerente", "crm_sales_unit.group_manager", self.gerencia.id)
-        self.coordenador = self._make_user("Coordenador", "coordenador", "crm_sales_unit.group_coordinator", self.coordenacao.id)
-
-    def _make_user(self, name, login, group_xmlid, sales_unit_id):
-        """Cria usuários de teste vinculados a unidades e grupos"""
-        return self.Users.create({
-            'name': name,
-            'login': login,
-            'sales_unit_id': sales_unit_id,
-            'groups_id': [(6, 0, [self.env.ref(group_xmlid).id])],
-        })
+class TestResUsers(SalesHierarchyCase):
 
     # ===========================
     # TESTES DE CRIAÇÃO
@@ -70,11 +33,7 @@ class TestResUsers(TransactionCase):
         })
         self.assertEqual(novo.sales_unit_id, self.coordenacao)
 
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria B',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria B', 'diretoria')
         with self.assertRaises(UserError):
             self.Users.with_user(self.gerente).create({
                 'name': 'Fora',
@@ -90,11 +49,7 @@ class TestResUsers(TransactionCase):
         })
         self.assertEqual(novo.sales_unit_id, self.coordenacao)
 
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria X',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria X', 'diretoria')
         with self.assertRaises(UserError):
             self.Users.with_user(self.diretor).create({
                 'name': 'Invasor',
@@ -103,11 +58,7 @@ class TestResUsers(TransactionCase):
             })
 
     def test_socio_cria_sem_restricao(self):
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria Livre',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria Livre', 'diretoria')
         novo = self.Users.with_user(self.socio).create({
             'name': 'Livre',
             'login': 'livre',
@@ -115,6 +66,28 @@ class TestResUsers(TransactionCase):
         })
         self.assertEqual(novo.sales_unit_id, outra_diretoria)
 
+    def test_criacao_em_lote(self):
+        Log = self.env['crm.sales.unit.hierarchy.log']
+        novos = self.Users.with_user(self.coordenador).create([
+            {'name': f'Lote {i}', 'login': f'lote_criacao_{i}'} for i in range(3)
+        ])
+        self.assertEqual(novos.sales_unit_id, self.coordenacao)
+        self.assertTrue(novos <= self.coordenacao.member_ids)
+
+        # Um único log para o lote inteiro
+        logs = Log.search([('user_ids', 'in', novos.ids)])
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs.user_ids, novos)
+        self.assertTrue(novos <= self.coordenador.allowed_user_ids)
+
+    def test_convites_preparados_em_lote(self):
+        if 'signup_type' not in self.env['res.partner']._fields:
+            self.skipTest("auth_signup não instalado")
+        novos = self.Users.with_user(self.coordenador).create([
+            {'name': f'Convite {i}', 'login': f'convite_{i}'} for i in range(2)
+        ])
+        self.assertEqual(novos.partner_id.mapped('signup_type'), ['signup', 'signup'])
+
     # ===========================
     # TESTES DE MOVIMENTAÇÃO
     # ===========================
@@ -129,11 +102,7 @@ class TestResUsers(TransactionCase):
         user.with_user(self.gerente).write({'sales_unit_id': self.coordenacao.id})
         self.assertEqual(user.sales_unit_id, self.coordenacao)
 
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria Y',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria Y', 'diretoria')
         with self.assertRaises(AccessError):
             user.with_user(self.gerente).write({'sales_unit_id': outra_diretoria.id})
 
@@ -142,21 +111,13 @@ class TestResUsers(TransactionCase):
         user.with_user(self.diretor).write({'sales_unit_id': self.gerencia.id})
         self.assertEqual(user.sales_unit_id, self.gerencia)
 
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria Z',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria Z', 'diretoria')
         with self.assertRaises(AccessError):
             user.with_user(self.diretor).write({'sales_unit_id': outra_diretoria.id})
 
     def test_socio_pode_mover_sem_restricao(self):
         user = self._make_user("Vendedor", "vend4", "base.group_user", self.coordenacao.id)
-        outra_diretoria = self.SalesUnit.create({
-            'name': 'Diretoria Livre 2',
-            'type': 'diretoria',
-            'responsible_id': self.admin.id,
-        })
+        outra_diretoria = self._make_unit('Diretoria Livre 2', 'diretoria')
         user.with_user(self.socio).write({'sales_unit_id': outra_diretoria.id})
         self.assertEqual(user.sales_unit_id, outra_diretoria)
 
@@ -175,3 +136,196 @@ class TestResUsers(TransactionCase):
                     self.env.ref("crm_sales_unit.group_director").id,
                 ])],
             })
+
+    def test_trigger_de_cargo_exclusivo(self):
+        diretor = self.env.ref("crm_sales_unit.group_director")
+        self.env.flush_all()
+
+        # Inserção direta (sem passar pelo ORM): o trigger barra ao verificar as pendências
+        with self.assertRaises(psycopg2.errors.CheckViolation), mute_logger('odoo.sql_db'), self.env.cr.savepoint():
+            self.env.cr.execute(
+                "INSERT INTO res_groups_users_rel (gid, uid) VALUES (%s, %s)", [diretor.id, self.gerente.id]
+            )
+            self.env.cr.execute("SET CONSTRAINTS crm_sales_unit_exclusive_role IMMEDIATE")
+
+        # Pelo grupo (sem passar por res.users.write): erro legível, antes do COMMIT
+        diretor.write({'users': [(4, self.gerente.id)]})
+        self.env.flush_all()
+        with self.assertRaisesRegex(ValidationError, "múltiplos cargos"):
+            self.gerente._check_exclusive_role_trigger()
+
+    # ===========================
+    # TESTES DE VISIBILIDADE
+    # ===========================
+
+    def test_visibilidade_calculada_em_lote(self):
+        chefe = self._make_user("Chefe", "chefe", "base.group_user", None)
+        sub_chefe = self._make_user("Subchefe", "subchefe", "base.group_user", None)
+        raiz = self.SalesUnit.create({
+            'name': 'Diretoria V',
+            'type': 'diretoria',
+            'parent_id': self.presidencia.id,
+            'responsible_id': chefe.id,
+        })
+        sub = self.SalesUnit.create({
+            'name': 'Gerência V',
+            'type': 'gerencia',
+            'parent_id': raiz.id,
+            'responsible_id': sub_chefe.id,
+        })
+        membro = self._make_user("Membro", "membro_v", "base.group_user", sub.id)
+
+        allowed = (chefe | sub_chefe | membro | self.socio)._get_allowed_user_map()
+        self.assertTrue({chefe.id, sub_chefe.id, membro.id} <= allowed[chefe.id])
+        self.assertIn(membro.id, allowed[sub_chefe.id])
+        self.assertNotIn(chefe.id, allowed[sub_chefe.id])
+        self.assertEqual(allowed[membro.id], {membro.id})
+        self.assertIn(membro.id, allowed[self.socio.id])
+
+    def test_troca_de_responsavel_recalcula_visibilidade(self):
+        # Sem dependências estruturais no compute: o write da unidade recalcula os afetados
+        vendedor = self._make_user("Vendedor", "vendedor_resp", "base.group_user", self.coordenacao.id)
+        novo_chefe = self._make_user("Novo Chefe", "novo_chefe", "base.group_user", self.gerencia.id)
+        self.assertIn(vendedor, self.coordenador.allowed_user_ids)
+
+        self.coordenacao.write({'responsible_id': novo_chefe.id})
+        self.assertNotIn(vendedor, self.coordenador.allowed_user_ids)
+        self.assertIn(vendedor, novo_chefe.allowed_user_ids)
+        self.assertIn(vendedor, self.gerente.allowed_user_ids)
+
+    # ===========================
+    # TESTES DE REORGANIZAÇÃO
+    # ===========================
+
+    def test_transferencia_em_lote_registra_log(self):
+        vendedores = self._make_user("V1", "lote1", "base.group_user", self.coordenacao.id)
+        vendedores |= self._make_user("V2", "lote2", "base.group_user", self.coordenacao.id)
+
+        log = self.gerencia.with_user(self.diretor).action_transfer_members(vendedores)
+        self.assertEqual(vendedores.mapped('sales_unit_id'), self.gerencia)
+        self.assertEqual(log.operation, 'members')
+        self.assertEqual(log.user_ids, vendedores)
+        self.assertEqual(log.source_unit_ids, self.coordenacao)
+
+    def test_mover_subarvore_recalcula_ancestrais(self):
+        vendedor = self._make_user("Vendedor Sub", "vendedor_sub", "base.group_user", self.coordenacao.id)
+        outra_diretoria = self._make_unit('Diretoria Destino Sub', 'diretoria')
+        novo_diretor = outra_diretoria.responsible_id
+        self.assertIn(vendedor, self.diretor.allowed_user_ids)
+        self.assertNotIn(vendedor, novo_diretor.allowed_user_ids)
+
+        log = self.coordenacao.with_user(self.socio).action_move_subtree(outra_diretoria)
+        self.assertEqual(self.coordenacao.parent_id, outra_diretoria)
+        self.assertEqual(log.operation, 'subtree')
+        self.assertEqual(log.source_unit_ids, self.gerencia)
+        self.assertIn(vendedor, log.user_ids)
+
+        # Cadeia antiga perde a subárvore; a nova passa a enxergá-la
+        self.assertNotIn(vendedor, self.gerente.allowed_user_ids)
+        self.assertNotIn(self.coordenador, self.diretor.allowed_user_ids)
+        self.assertTrue(vendedor | self.coordenador <= novo_diretor.allowed_user_ids)
+        self.assertIn(vendedor, self.coordenador.allowed_user_ids)
+        self.assertIn(vendedor, self.socio.allowed_user_ids)
+
+    def test_mover_subarvore_para_dentro_dela_mesma(self):
+        with self.assertRaises(UserError):
+            self.gerencia.with_user(self.socio).action_move_subtree(self.coordenacao)
+        self.assertEqual(self.gerencia.parent_id, self.directoria)
+
+    def test_mover_subarvore_fora_da_hierarquia(self):
+        outra_diretoria = self._make_unit('Diretoria Alheia', 'diretoria')
+        # Destino fora da gerência
+        with self.assertRaises(AccessError):
+            self.coordenacao.with_user(self.gerente).action_move_subtree(outra_diretoria)
+        # A própria unidade do gerente não pode ser movida por ele
+        with self.assertRaises(AccessError):
+            self.gerencia.with_user(self.gerente).action_move_subtree(self.directoria)
+        self.assertEqual(self.coordenacao.parent_id, self.gerencia)
+
+    def test_organograma_respeita_hierarquia(self):
+        arvore = self.SalesUnit.with_user(self.gerente).get_org_tree()
+        self.assertEqual([no['id'] for no in arvore], [self.gerencia.id])
+        filhos = arvore[0]['children']
+        self.assertEqual([no['id'] for no in filhos], [self.coordenacao.id])
+        self.assertEqual(filhos[0]['responsible']['id'], self.coordenador.id)
+        self.assertEqual(filhos[0]['member_count'], 1)
+
+        # Novo membro invalida a estrutura em cache
+        self._make_user("Novo", "novo_org", "base.group_user", self.coordenacao.id)
+        arvore = self.SalesUnit.with_user(self.gerente).get_org_tree()
+        self.assertEqual(arvore[0]['children'][0]['member_count'], 2)
+
+    def test_versao_da_hierarquia(self):
+        Log = self.env['crm.sales.unit.hierarchy.log']
+        versao = Log._get_hierarchy_version()
+
+        vendedor = self._make_user("Versão", "versao", "base.group_user", self.coordenacao.id)
+        self.assertGreater(Log._get_hierarchy_version(), versao)
+
+        versao = Log._get_hierarchy_version()
+        vendedor.with_user(self.gerente).write({'sales_unit_id': self.gerencia.id})
+        self.assertGreater(Log._get_hierarchy_version(), versao)
+        log = Log.search([('version', '=', Log._get_hierarchy_version())])
+        self.assertEqual(log.change_type, 'user_write')
+        self.assertEqual(log.unit_ids, self.coordenacao | self.gerencia)
+
+        # Alterações fora da hierarquia não geram nova versão
+        versao = Log._get_hierarchy_version()
+        vendedor.write({'name': 'Outro nome'})
+        self.assertEqual(Log._get_hierarchy_version(), versao)
+
+        # Com mudanças não commitadas, os caches usam uma chave só desta transação
+        chave = Log._get_hierarchy_cache_key()
+        self.assertIsInstance(chave, tuple)
+        self.assertEqual(chave[0], versao)
+        vendedor.write({'sales_unit_id': self.coordenacao.id})
+        self.assertNotEqual(Log._get_hierarchy_cache_key(), chave)
+
+    def test_recalculo_grande_vai_para_segundo_plano(self):
+        self.env['ir.config_parameter'].sudo().set_param('crm_sales_unit.visibility_sync_threshold', 0)
+        Job = self.env['crm.sales.unit.visibility.job']
+        jobs_antes = Job.search([])
+
+        vendedor = self._make_user("Fila", "fila_vis", "base.group_user", self.coordenacao.id)
+        job = Job.search([]) - jobs_antes
+        self.assertEqual(len(job), 1)
+        self.assertIn(vendedor, job.user_ids)
+        self.assertEqual(job.state, 'pending')
+
+        job._process(chunk_size=2)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.processed_count, job.total_count)
+        self.assertIn(vendedor, self.gerente.allowed_user_ids)
+
+    def test_job_conclui_apesar_de_mudanca_na_hierarquia(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        ICP.set_param('crm_sales_unit.visibility_sync_threshold', 0)
+        vendedor = self._make_user("Móvel", "movel_vis", "base.group_user", self.coordenacao.id)
+        job = self.env['crm.sales.unit.visibility.job'].search([], limit=1)
+        self.assertIn(self.gerente, job.user_ids)
+
+        # Pares preparados antes de uma mudança síncrona na hierarquia
+        allowed_map = job.user_ids._get_allowed_user_map()
+        pairs = [(job.id, user_id, allowed_id) for user_id, ids in allowed_map.items() for allowed_id in ids]
+        self.env.cr.executemany(
+            "INSERT INTO crm_sales_unit_visibility_stage (job_id, user_id, allowed_id) VALUES (%s, %s, %s)",
+            pairs,
+        )
+        # Snapshot anterior a esta transação: as mudanças abaixo contam como concorrentes
+        self.env.cr.execute("SELECT txid_current()")
+        xid = self.env.cr.fetchone()[0]
+        job.write({
+            'state': 'running',
+            'last_user_id': max(job.user_ids.ids),
+            'hierarchy_snapshot': f"{xid}:{xid}:",
+        })
+
+        ICP.set_param('crm_sales_unit.visibility_sync_threshold', 10000)
+        outra_diretoria = self._make_unit('Diretoria Móvel', 'diretoria')
+        vendedor.write({'sales_unit_id': outra_diretoria.id})
+
+        # O job termina, e só os usuários afetados pela mudança são recalculados
+        self.assertTrue(job._process(chunk_size=2))
+        self.assertEqual(job.state, 'done')
+        self.assertNotIn(vendedor, self.gerente.allowed_user_ids)
+        self.assertIn(vendedor, outra_diretoria.responsible_id.allowed_user_ids)
@@ -0,0 +1,315 @@
+from datetime import date, datetime, timedelta
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.crm_sales_unit.controllers.funnel_controller import _to_funnel_day, _to_utc_datetime
+from odoo.addons.crm_sales_unit.models.crm_lead_stage_history import HISTORY_BUFFER_KEY
+
+
+class TestStageHistory(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Stage = self.env['crm.stage']
+        self.History = self.env['crm.lead.stage.history']
+        self.stage_novo = self.Stage.create({'name': 'Novo', 'funnel_sequence': 1001})
+        self.stage_contato = self.Stage.create({'name': 'Primeiro Contato', 'funnel_sequence': 1002})
+        self.stage_reagendar = self.Stage.create({
+            'name': 'Reagendar', 'funnel_sequence': 1003, 'funnel_skip': True,
+        })
+        self.stage_qualificando = self.Stage.create({'name': 'Qualificando', 'funnel_sequence': 1004})
+        self.user = self.env.ref("base.user_admin")
+
+    def _history(self, lead):
+        return self.History.search([('lead_id', '=', lead.id)], order='id')
+
+    def test_historico_acumulado_ate_o_precommit(self):
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Buffer',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        lead.write({'stage_id': self.stage_qualificando.id})
+
+        buffered = self.env.cr.precommit.data.get(HISTORY_BUFFER_KEY)
+        self.assertEqual(sum(len(batch) for batch in buffered), 3)
+
+        self.env.cr.precommit.run()
+        self.assertNotIn(HISTORY_BUFFER_KEY, self.env.cr.precommit.data)
+        self.assertEqual(
+            self._history(lead).mapped('stage_id'),
+            self.stage_novo | self.stage_contato | self.stage_qualificando,
+        )
+
+    def test_historico_descarta_leads_desfeitos_por_savepoint(self):
+        mantido = self.env['crm.lead'].create({
+            'name': 'Lead Mantido',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        # Como o load() com erro em uma linha: o lead some, o buffer fica
+        with self.assertRaises(ValueError), self.env.cr.savepoint():
+            desfeito = self.env['crm.lead'].create({
+                'name': 'Lead Desfeito',
+                'user_id': self.user.id,
+                'stage_id': self.stage_novo.id,
+            })
+            desfeito_id = desfeito.id
+            self.env.flush_all()
+            raise ValueError("linha inválida")
+        self.env.invalidate_all()
+
+        self.env.cr.precommit.run()
+        self.assertEqual(self._history(mantido).stage_id, self.stage_novo)
+        self.assertFalse(self.History.search([('lead_id', '=', desfeito_id)]))
+
+    def test_historico_descarta_mudanca_desfeita_por_savepoint(self):
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Existente',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        # O lead continua existindo; só a mudança de etapa é desfeita
+        with self.assertRaises(ValueError), self.env.cr.savepoint():
+            lead.write({'stage_id': self.stage_qualificando.id})
+            raise ValueError("linha inválida")
+        self.env.invalidate_all()
+        lead.write({'stage_id': self.stage_contato.id})
+
+        self.env.cr.precommit.run()
+        self.assertEqual([h.stage_id for h in self._history(lead)], [self.stage_novo, self.stage_contato])
+
+    def test_busca_sem_lead_nao_antecipa_o_buffer(self):
+        self.env['crm.lead'].create({
+            'name': 'Lead Relatório',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        self.History.search([('stage_id', '=', self.stage_novo.id)])
+        self.assertIn(HISTORY_BUFFER_KEY, self.env.cr.precommit.data)
+
+    def test_transicoes_do_funil(self):
+        transitions = self.Stage._get_funnel_transitions()
+        self.assertEqual(
+            transitions[(self.stage_novo.id, self.stage_qualificando.id)],
+            (self.stage_contato.id,),
+        )
+        self.assertNotIn((self.stage_qualificando.id, self.stage_novo.id), transitions)
+
+        # Mudanças no funil invalidam a tabela em cache
+        self.stage_reagendar.funnel_skip = False
+        self.assertEqual(
+            self.Stage._get_funnel_transitions()[(self.stage_novo.id, self.stage_qualificando.id)],
+            (self.stage_contato.id, self.stage_reagendar.id),
+        )
+
+    def test_busca_grava_buffer_pendente(self):
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Busca',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        history = self._history(lead)
+        self.assertEqual(history.stage_id, self.stage_novo)
+        self.assertEqual(history.lead_creation_date, lead.create_date)
+        self.assertNotIn(HISTORY_BUFFER_KEY, self.env.cr.precommit.data)
+
+    def test_fotografia_de_utm_nao_e_recalculada(self):
+        source = self.env['utm.source'].create({'name': 'Portal'})
+        other_source = self.env['utm.source'].create({'name': 'Indicação'})
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead UTM',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+            'source_id': source.id,
+        })
+        history = self._history(lead)
+        self.assertEqual(history.source_id, source)
+
+        lead.source_id = other_source
+        self.env.flush_all()
+        history.invalidate_recordset()
+        self.assertEqual(history.source_id, source)
+
+        self.History._backfill_snapshots()
+        self.assertEqual(history.source_id, other_source)
+
+    def test_funil_diario_conta_leads_distintos(self):
+        Daily = self.env['crm.lead.stage.funnel.daily']
+        leads = self.env['crm.lead'].create([
+            {'name': 'Lead A', 'user_id': self.user.id, 'stage_id': self.stage_novo.id},
+            {'name': 'Lead B', 'user_id': self.user.id, 'stage_id': self.stage_novo.id},
+        ])
+        leads[0].write({'stage_id': self.stage_contato.id})
+        leads[0].write({'stage_id': self.stage_novo.id})
+
+        Daily._cron_update_rollup()
+        rows = Daily.search([('stage_id', '=', self.stage_novo.id), ('user_id', '=', self.user.id)])
+        self.assertEqual(sum(rows.mapped('lead_count')), 2)
+
+        # Sem dias marcados, a execução seguinte não reconsolida nada
+        self.assertEqual(Daily._cron_update_rollup(), 0)
+        rows = Daily.search([('stage_id', '=', self.stage_novo.id), ('user_id', '=', self.user.id)])
+        self.assertEqual(sum(rows.mapped('lead_count')), 2)
+
+        # Histórico de dias anteriores (commit atrasado) marca o seu próprio dia
+        self.History.create({
+            'lead_id': leads[1].id,
+            'stage_id': self.stage_contato.id,
+            'user_id': self.user.id,
+            'date_stage_change': fields.Datetime.now() - timedelta(days=3),
+        })
+        self.assertEqual(Daily._cron_update_rollup(), 1)
+        rows = Daily.search([('stage_id', '=', self.stage_contato.id), ('user_id', '=', self.user.id)])
+        self.assertEqual(len(rows.mapped('day')), 2)
+        self.assertEqual(sum(rows.mapped('lead_count')), 2)
+
+        # Linha atrasada anterior à primeira passagem: o lead sai do dia antigo e vai para o novo
+        self.History.create({
+            'lead_id': leads[0].id,
+            'stage_id': self.stage_novo.id,
+            'user_id': self.user.id,
+            'date_stage_change': fields.Datetime.now() - timedelta(days=5),
+        })
+        self.assertEqual(Daily._cron_update_rollup(), 2)
+        rows = Daily.search([('stage_id', '=', self.stage_novo.id), ('user_id', '=', self.user.id)])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows.mapped('lead_count'), [1, 1])
+
+    def _count_distinct_history(self, stage_ids, user_id=None):
+        """Contagem antiga do painel: COUNT(DISTINCT lead_id) sobre o histórico bruto"""
+        self.env.flush_all()
+        domain = [('stage_id', 'in', stage_ids)] + ([('user_id', '=', user_id)] if user_id else [])
+        return {
+            stage.id: count
+            for stage, count in self.History._read_group(domain, ['stage_id'], ['lead_id:count_distinct'])
+        }
+
+    def test_painel_le_o_funil_diario(self):
+        Daily = self.env['crm.lead.stage.funnel.daily']
+        outro = self.env['res.users'].create({'name': 'Outro Corretor', 'login': 'outro_funil'})
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Painel',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        lead.write({'stage_id': self.stage_contato.id})
+        lead.write({'stage_id': self.stage_novo.id})
+        lead.write({'user_id': outro.id})
+        Daily._cron_update_rollup()
+        stages = [self.stage_novo.id, self.stage_contato.id]
+
+        # Sem filtro de corretor, os números batem com a contagem antiga
+        counts = Daily._count_leads_by_stage(stages)
+        self.assertEqual(counts, {self.stage_novo.id: 1, self.stage_contato.id: 1})
+        self.assertEqual(counts, self._count_distinct_history(stages))
+
+        hoje = fields.Date.context_today(Daily)
+        self.assertEqual(Daily._count_leads_by_stage(stages, day_to=hoje - timedelta(days=1)), {})
+
+        # Mudança documentada: o lead conta para o corretor da primeira passagem,
+        # não de novo para quem o recebeu na redistribuição
+        self.assertEqual(Daily._count_leads_by_stage(stages, user_id=outro.id), {})
+        self.assertEqual(self._count_distinct_history(stages, user_id=outro.id), {self.stage_novo.id: 1})
+
+    def test_datas_iso_do_painel(self):
+        # Datas simples, com espaço ou com 'T' (e fuso) vindas do cliente
+        self.assertEqual(_to_funnel_day('2024-03-01'), date(2024, 3, 1))
+        self.assertEqual(_to_funnel_day('2024-03-01T10:00:00'), date(2024, 3, 1))
+        self.assertEqual(_to_funnel_day('2024-03-01T01:00:00Z'), date(2024, 2, 29))
+        self.assertEqual(_to_utc_datetime('2024-03-01T10:00:00.5'), datetime(2024, 3, 1, 10, 0, 0, 500000))
+        self.assertEqual(_to_utc_datetime('2024-03-01 10:00:00-03:00'), datetime(2024, 3, 1, 13, 0))
+        with self.assertRaises(ValueError):
+            _to_funnel_day('01/03/2024')
+
+    def test_backfill_reconsolida_funil_diario(self):
+        Daily = self.env['crm.lead.stage.funnel.daily']
+        source = self.env['utm.source'].create({'name': 'Feirão'})
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Backfill',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        Daily._cron_update_rollup()
+        self.assertFalse(Daily.search([('stage_id', '=', self.stage_novo.id)]).source_id)
+
+        lead.source_id = source
+        self.History._backfill_snapshots()
+        self.assertGreaterEqual(Daily._cron_update_rollup(), 1)
+        self.assertEqual(Daily.search([('stage_id', '=', self.stage_novo.id)]).source_id, source)
+
+    def test_fato_uma_linha_por_lead_etapa_responsavel(self):
+        lead = self.env['crm.lead'].create({
+            'name': 'Lead Fato',
+            'user_id': self.user.id,
+            'stage_id': self.stage_novo.id,
+        })
+        lead.write({'stage_id': self.stage_contato.id})
+        lead.write({'stage_id': self.stage_novo.id})
+        self.env.cr.precommit.run()
+
+        reached = self.env['crm.lead.stage.reached'].search([
+            ('lead_id', '=', lead.id),
+            ('stage_id', '=', self.stage_novo.id),
+        ])
+        self.assertEqual(len(reached), 1)
+        self.assertEqual(reached.reach_count, 2)
+        self.assertLessEqual(reached.first_reached, reached.last_reached)
+
+    def test_exportacao_pagina_entre_lotes(self):
+        lead = self.env['crm.lead'].create({'name': 'Lead Exportação'})
+        data = fields.Datetime.now().replace(microsecond=0)
+        # Mesma data em todas as linhas: o desempate por id atravessa os lotes
+        history = self.History.create([{
+            'lead_id': lead.id,
+            'stage_id': self.stage_novo.id,
+            'user_id': self.user.id,
+            'date_stage_change': data,
+        } for _i in range(5)])
+        # Linhas antigas podem não ter a data de criação do lead
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE crm_lead_stage_history SET lead_creation_date = NULL WHERE id = %s", [history[0].id]
+        )
+        self.History.invalidate_model(['lead_creation_date'])
+
+        batches = list(self.History._iter_export_batches([('lead_id', '=', lead.id)], batch_size=2))
+        self.assertEqual([len(rows) for rows in batches], [2, 2, 1])
+        rows = [row for rows in batches for row in rows]
+        self.assertEqual([row['id'] for row in rows], history.sorted('id').ids)
+        self.assertEqual(rows[0]['date_stage_change'], fields.Datetime.to_string(data))
+        self.assertIsNone(rows[0]['lead_creation_date'])
+        self.assertIsNone(rows[0]['source_id'])
+        # As colunas do cabeçalho são as chaves das linhas, na mesma ordem
+        self.assertEqual(self.History._get_export_columns(), list(rows[0]))
+        self.assertEqual(list(self.History._iter_export_batches([('id', '=', 0)])), [])
+
+    def test_arquivamento_move_apenas_historico_antigo(self):
+        Archive = self.env['crm.lead.stage.history.archive']
+        self.env['ir.config_parameter'].sudo().set_param('crm_sales_unit.history_hot_months', 1)
+        lead = self.env['crm.lead'].create({'name': 'Lead Arquivo'})
+        agora = fields.Datetime.now()
+        antigos = self.History.create([{
+            'lead_id': lead.id,
+            'stage_id': self.stage_novo.id,
+            'user_id': self.user.id,
+            'date_stage_change': agora - timedelta(days=120 + i),
+        } for i in range(3)])
+        recente = self.History.create({
+            'lead_id': lead.id,
+            'stage_id': self.stage_contato.id,
+            'user_id': self.user.id,
+            'date_stage_change': agora,
+        })
+
+        self.assertGreaterEqual(Archive._cron_archive_old_history(batch_size=2), 3)
+        self.assertEqual(self._history(lead), recente)
+        arquivados = Archive.search([('lead_id', '=', lead.id)])
+        self.assertEqual(sorted(arquivados.mapped('date_stage_change')), sorted(antigos.mapped('date_stage_change')))
+        self.assertEqual(arquivados.stage_id, self.stage_novo)
+
+        # Nova execução não move nem duplica nada
+        self.assertEqual(Archive._cron_archive_old_history(batch_size=2), 0)
+        self.assertEqual(self._history(lead), recente)
+        self.assertEqual(Archive.search_count([('lead_id', '=', lead.id)]), 3)
@@ -0,0 +1,70 @@
+from odoo.addons.crm_sales_unit.tests.common import SalesHierarchyCase
+from odoo.exceptions import AccessError
+
+
+class TestVisibility(SalesHierarchyCase):
+    """Leads, contatos e histórico visíveis por cargo, antes e depois de mudanças na hierarquia"""
+
+    def setUp(self):
+        super().setUp()
+        self.corretor = self._make_user("Corretor", "corretor", "sales_team.group_sale_salesman", self.coordenacao.id)
+        self.externo = self._make_user("Externo", "externo", "sales_team.group_sale_salesman", None)
+        self.donos = self.socio | self.diretor | self.gerente | self.coordenador | self.corretor | self.externo
+
+        self.leads = self.env['crm.lead'].create([
+            {'name': f'Lead {dono.name}', 'user_id': dono.id} for dono in self.donos
+        ])
+        self.partners = self.env['res.partner'].create([
+            {'name': f'Contato {dono.name}', 'user_id': dono.id} for dono in self.donos
+        ])
+        # Histórico acumulado no buffer é gravado no precommit
+        self.env.cr.precommit.run()
+        self.history = self.env['crm.lead.stage.history'].search([('lead_id', 'in', self.leads.ids)])
+        self.assertEqual(self.history.user_id, self.donos)
+
+    def _make_unit(self, name, unit_type, parent=None):
+        unit = super()._make_unit(name, unit_type, parent)
+        # O responsável também precisa de acesso aos leads
+        unit.responsible_id.write({'groups_id': [(4, self.env.ref('sales_team.group_sale_salesman').id)]})
+        return unit
+
+    def _assert_visiveis(self, user, esperados):
+        """user enxerga exatamente os registros dos donos esperados, nos três modelos"""
+        for records in (self.leads, self.partners, self.history):
+            visiveis = records.with_user(user).search([('id', 'in', records.ids)])
+            self.assertEqual(visiveis.user_id, esperados, f"{records._name} visto por {user.name}")
+            visiveis.check_access('read')
+            for record in records - visiveis:
+                with self.assertRaises(AccessError):
+                    record.with_user(user).check_access('read')
+
+    def test_visibilidade_por_cargo(self):
+        abaixo_da_gerencia = self.gerente | self.coordenador | self.corretor
+        self._assert_visiveis(self.socio, self.donos)
+        self._assert_visiveis(self.diretor, self.diretor | abaixo_da_gerencia)
+        self._assert_visiveis(self.gerente, abaixo_da_gerencia)
+        self._assert_visiveis(self.coordenador, self.coordenador | self.corretor)
+        self._assert_visiveis(self.corretor, self.corretor)
+        self._assert_visiveis(self.externo, self.externo)
+
+    def test_visibilidade_apos_mover_usuario(self):
+        outra_diretoria = self._make_unit('Diretoria Destino', 'diretoria')
+        self.corretor.with_user(self.socio).write({'sales_unit_id': outra_diretoria.id})
+
+        self._assert_visiveis(self.socio, self.donos)
+        self._assert_visiveis(self.diretor, self.diretor | self.gerente | self.coordenador)
+        self._assert_visiveis(self.gerente, self.gerente | self.coordenador)
+        self._assert_visiveis(self.coordenador, self.coordenador)
+        self._assert_visiveis(self.corretor, self.corretor)
+        self._assert_visiveis(outra_diretoria.responsible_id, self.corretor)
+
+    def test_visibilidade_apos_mover_unidade(self):
+        outra_diretoria = self._make_unit('Diretoria Nova', 'diretoria')
+        self.coordenacao.write({'parent_id': outra_diretoria.id})
+
+        self._assert_visiveis(self.socio, self.donos)
+        self._assert_visiveis(self.diretor, self.diretor | self.gerente)
+        self._assert_visiveis(self.gerente, self.gerente)
+        self._assert_visiveis(self.coordenador, self.coordenador | self.corretor)
+        self._assert_visiveis(outra_diretoria.responsible_id, self.coordenador | self.corretor)
+        self._assert_visiveis(self.externo, self.externo)